@@ -0,0 +1,156 @@
+from __future__ import print_function
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from multiprocessing.util import Finalize
+import textonic
+from cache import RenderCache
+
+# each pool process renders with its own TexTonic, and so its own temp dir
+_tex = None
+_opts = None
+
+def _initWorker(opts):
+    global _tex, _opts
+    _opts = opts
+    _tex = textonic.TexTonic(max(opts['res']),RenderCache(opts['cache']) if opts['cache'] is not False else None)
+    _tex.outline = opts['outline']
+    if opts['latex']: _tex.latex = opts['latex']
+    if opts['gs']: _tex.gs = opts['gs']
+    _tex.profileLog = opts.get('profile')
+    Finalize(None,_tex.cleanup,exitpriority=10)
+
+def _renderOne(item):
+    ident, source = item
+    t = time.time()
+    result = {'id':ident, 'outputs':{}, 'error':None}
+    _tex.startProfile(ident)
+    try:
+        if not isinstance(source,bytes): source = source.encode('utf-8')
+        src = _tex.runLatex(textonic.wrapSource(source))
+        for fmt in _opts['formats']:
+            if fmt == 'PNG' and len(_opts['res']) > 1:
+                # one raster at the highest resolution, downsampled for the others
+                for res, fn in _tex.convertScaled(src,_opts['res']).items():
+                    dest = os.path.join(_opts['outdir'],'%s_%d.png'%(ident,res))
+                    shutil.copyfile(os.path.join(_tex.dir,fn),dest)
+                    result['outputs']['PNG_%d'%res] = dest
+                continue
+            dest = os.path.join(_opts['outdir'],'%s.%s'%(ident,fmt.lower()))
+            shutil.copyfile(os.path.join(_tex.dir,_tex.convert(src,fmt)),dest)
+            result['outputs'][fmt] = dest
+    except textonic.LatexError as E:
+        # the line as numbered in the snippet, rather than in the wrapped document
+        result['error'] = E.message
+        result['line'] = textonic.snippetLine(source,E.line)
+    except Exception as E:
+        result['error'] = str(E) or E.__class__.__name__
+    _tex.finishProfile()
+    result['time'] = time.time()-t
+    return result
+
+def _renderGroup(group):
+    # several snippets sharing a preamble, compiled in one LaTeX run
+    if len(group) == 1: return [_renderOne(group[0])]
+    t = time.time()
+    sources = [s if isinstance(s,bytes) else s.encode('utf-8') for ident, s in group]
+    _tex.startProfile(','.join(ident for ident, s in group))
+    try:
+        packed = _tex.renderPacked(sources,_opts['formats'])
+    except Exception as E:
+        packed = [{'outputs':{}, 'error':str(E)} for s in sources]
+    _tex.finishProfile()
+    elapsed = time.time()-t
+    results = []
+    for (ident, source), r in zip(group,packed):
+        result = {'id':ident, 'outputs':{}, 'error':r['error'], 'time':elapsed/len(group)}
+        if 'line' in r: result['line'] = r['line']
+        for fmt, fn in r['outputs'].items():
+            dest = os.path.join(_opts['outdir'],'%s.%s'%(ident,fmt.lower()))
+            shutil.copyfile(os.path.join(_tex.dir,fn),dest)
+            result['outputs'][fmt] = dest
+        results.append(result)
+    return results
+
+def packItems(items, size):
+    # group bare snippets by their preamble lines, full documents go on their own
+    groups = {}
+    for ident, source in items:
+        if r'\begin{document}' in source or r'\documentclass' in source:
+            yield [(ident,source)]
+            continue
+        key = textonic.splitSnippet(source)[0]
+        groups.setdefault(key,[]).append((ident,source))
+        if len(groups[key]) >= size:
+            yield groups.pop(key)
+    for group in groups.values():
+        yield group
+
+def readSnippets(paths):
+    # .tex files are one snippet each, anything else (or - for stdin) is JSON lines of {"id":..., "source":...}
+    for path in paths:
+        if path.endswith('.tex'):
+            yield os.path.splitext(os.path.basename(path))[0], open(path,'rb').read()
+            continue
+        stream = sys.stdin if path == '-' else open(path,'r')
+        for n, line in enumerate(stream):
+            if not line.strip(): continue
+            rec = json.loads(line)
+            yield str(rec.get('id',n)), rec['source']
+
+def renderBatch(items, formats=('PNG',), outdir='.', workers=None, res=300, outline=True, latex=None, gs=None, cache=None, pack=1, profile=None):
+    # render (id, source) pairs across a pool of processes, yielding a result dict for each as it completes
+    # failures are reported per item in result['error'] rather than stopping the batch
+    # res may be a list, in which case PNGs are written as <id>_<res>.png for each
+    # with pack > 1, up to that many snippets sharing a preamble are compiled in one LaTeX run (single resolution only)
+    # with profile set, each render's per-stage timings are appended to that file as JSON lines
+    if not os.path.isdir(outdir): os.makedirs(outdir)
+    opts = dict(formats=[f.upper() for f in formats],outdir=outdir,res=res if isinstance(res,(list,tuple)) else [res],outline=outline,latex=latex,gs=gs,cache=cache,profile=profile and os.path.abspath(profile))
+    pool = multiprocessing.Pool(workers or multiprocessing.cpu_count(),_initWorker,(opts,))
+    try:
+        if pack > 1 and len(opts['res']) == 1:
+            for results in pool.imap_unordered(_renderGroup,packItems(items,pack)):
+                for result in results:
+                    yield result
+        else:
+            for result in pool.imap_unordered(_renderOne,items):
+                yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render LaTeX snippets without the GUI')
+    parser.add_argument('inputs',nargs='+',help='.tex files, or JSON lines files (- for stdin)')
+    parser.add_argument('-f','--format',action='append',choices=['EPS','PDF','PNG'],type=str.upper,help='output format, may be repeated (default PNG)')
+    parser.add_argument('-o','--outdir',default='.',help='directory for the rendered files')
+    parser.add_argument('-j','--workers',type=int,default=None,help='number of worker processes (default: one per core)')
+    parser.add_argument('-r','--res',type=int,action='append',help='raster resolution in dpi, may be repeated for several sizes of PNG (default 300)')
+    parser.add_argument('-p','--pack',type=int,default=1,help='compile up to this many snippets per LaTeX run')
+    parser.add_argument('--no-outline',dest='outline',action='store_false',help='keep fonts in EPS/PDF output')
+    parser.add_argument('--no-cache',dest='cache',action='store_false',default=None,help='disable the render cache')
+    parser.add_argument('--profile',help='append per-stage timings of each render to this file as JSON lines')
+    parser.add_argument('--latex',help='LaTeX executable')
+    parser.add_argument('--gs',help='Ghostscript executable')
+    args = parser.parse_args(argv)
+    paths = []
+    for p in args.inputs:
+        paths += sorted(glob.glob(p)) if p != '-' and glob.has_magic(p) else [p]
+    t = time.time()
+    count = failed = 0
+    for result in renderBatch(readSnippets(paths),args.format or ['PNG'],args.outdir,args.workers,args.res or [300],args.outline,args.latex,args.gs,args.cache,args.pack,args.profile):
+        count += 1
+        if result['error']: failed += 1
+        print(json.dumps(result))
+        sys.stdout.flush()
+    elapsed = time.time()-t
+    print('>> Rendered %d snippets (%d failed) in %.2f s, %.1f snippets/sec'%(count,failed,elapsed,count/elapsed if elapsed else 0),file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
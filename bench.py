@@ -0,0 +1,355 @@
+from __future__ import print_function
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import shutil
+import stat
+import sys
+import tempfile
+import time
+from distutils.spawn import find_executable
+import textonic
+
+# snippets covering the range the editor sees, from inline formulas to TikZ figures
+CORPUS = [
+    ('inline', r'$e^{i\pi} + 1 = 0$'),
+    ('fraction', r'$\displaystyle \frac{\partial^2 u}{\partial t^2} = c^2 \nabla^2 u + \sum_{n=0}^\infty \frac{x^n}{n!}$'),
+    ('aligned', '%!\\usepackage{amsmath}\n\\begin{align}\n' + ' \\\\\n'.join(
+        r'a_{%d} x + b_{%d} y + c_{%d} z &= \int_0^{%d} f_{%d}(t) \, \mathrm{d}t'%(i,i,i,i,i) for i in range(24)) + '\n\\end{align}'),
+    ('tikz', '%!\\usepackage{tikz}\n\\begin{tikzpicture}\n' + '\n'.join(
+        r'\draw[thick] (%d,0) circle (%.1f) node {$x_{%d}$};'%(i,0.2+0.05*i,i) for i in range(40)) + '\n\\end{tikzpicture}'),
+]
+
+# deterministic stand-ins for pdflatex and gs, whose cost grows with the size of the input
+# they run under the interpreter running the benchmark, so must work on Python 2 and 3
+STUB_LATEX = r'''
+import os, sys, time
+args = sys.argv[1:]
+if '--version' in args:
+    print('pdfTeX 3.14 (textonic benchmark stub)')
+    sys.exit(0)
+files = [a for a in args if not a.startswith('-') and not a.startswith('&')]
+job = None
+for a in args:
+    if a.startswith('-jobname='): job = a[9:]
+src = files[-1]
+job = job or os.path.splitext(src)[0]
+data = open(src,'rb').read()
+time.sleep(0.02)
+if '-ini' in args:
+    time.sleep(0.1)
+    open(job+'.fmt','wb').write(data)
+    print('Beginning to dump on file %s.fmt'%job)
+    sys.exit(0)
+# the preamble is only loaded when it didn't come precompiled
+preloaded = any(a.startswith('&') and os.path.isfile(a[1:]+'.fmt') for a in args)
+idx = data.find(b'\\begin{document}')
+time.sleep((0 if preloaded or idx < 0 else 0.1) + 2e-5*len(data) + 2e-3*data.count(b'\\draw'))
+log = ['This is pdfTeX, Version 3.14 (benchmark stub)','(./%s'%src]
+code = 0
+for n, line in enumerate(data.split(b'\n')):
+    if b'\\error' in line:
+        log += ['! Undefined control sequence.','l.%d %s'%(n+1,line.decode('utf-8','replace'))]
+        code = 1
+open(job+'.pdf','wb').write(b'%PDF-1.5\n' + data + b'\n%%EOF\n')
+log.append('Output written on %s.pdf (1 page, %d bytes).'%(job,len(data)))
+open(job+'.log','w').write('\n'.join(log)+'\n')
+print('\n'.join(log))
+sys.exit(code)
+'''
+
+STUB_GS = r'''
+import os, re, struct, sys, time, zlib
+args = sys.argv[1:]
+if '-v' in args or '--version' in args:
+    print('GPL Ghostscript 9.50 (textonic benchmark stub)')
+    sys.exit(0)
+if '-h' in args:
+    print('Available devices:\n   bbox bmp16m eps2write pdfwrite png16m pngalpha')
+    sys.exit(0)
+time.sleep(0.03)
+
+def extent(src):
+    # the inked area grows with the length of the source and its line breaks
+    data = open(src,'rb').read()
+    w = min(30 + len(data)/12.0, 460)
+    h = min(12 + 14*data.count(b'\\\\') + 2*data.count(b'\\draw'), 640)
+    return 100.5, 700.2-h, 100.5+w, 700.2
+
+def png(w,h,ink=None):
+    # transparent RGBA, opaque black over the pixel box ink (or everything)
+    x0, y0, x1, y1 = [int(v) for v in (ink or (0,0,w,h))]
+    x0, x1 = max(0,min(x0,w)), max(0,min(x1,w))
+    blank = b'\0' + b'\0\0\0\0'*w
+    inked = b'\0' + b'\0\0\0\0'*x0 + b'\0\0\0\xff'*(x1-x0) + b'\0\0\0\0'*(w-x1)
+    rows = b''.join(inked if y0 <= y < y1 else blank for y in range(h))
+    def chunk(t,d): return struct.pack('>I',len(d)) + t + d + struct.pack('>I',zlib.crc32(t+d) & 0xffffffff)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR',struct.pack('>IIBBBBB',w,h,8,6,0,0,0)) + chunk(b'IDAT',zlib.compress(rows,1)) + chunk(b'IEND',b'')
+
+def bmp(w,h,ink=None):
+    # 24-bit bottom-up rows on white, as bmp16m renders, black over the pixel box ink (or everything)
+    x0, y0, x1, y1 = [int(v) for v in (ink or (0,0,w,h))]
+    x0, x1 = max(0,min(x0,w)), max(0,min(x1,w))
+    pad = b'\0'*((4-3*w%4)%4)
+    blank = b'\xff'*(3*w) + pad
+    inked = b'\xff'*(3*x0) + b'\0'*(3*(x1-x0)) + b'\xff'*(3*(w-x1)) + pad
+    rows = b''.join(inked if y0 <= y < y1 else blank for y in reversed(range(h)))
+    return struct.pack('<2sIHHI',b'BM',54+len(rows),0,0,54) + struct.pack('<IiiHHIIiiII',40,w,h,1,24,0,len(rows),2835,2835,0,0) + rows
+
+def render(dev,src,out,res,size,offset):
+    # returns what the job writes to stderr
+    box = extent(src)
+    if dev == 'bbox':
+        time.sleep(0.002 + 1e-6*(box[2]-box[0])*(box[3]-box[1]))
+        return '%%%%BoundingBox: %d %d %d %d\n%%%%HiResBoundingBox: %.4f %.4f %.4f %.4f\n'%(
+            int(box[0]),int(box[1]),int(box[2])+1,int(box[3])+1,box[0],box[1],box[2],box[3])
+    if dev.startswith('png') or dev.startswith('bmp'):
+        k = res/72.0
+        raster = png if dev.startswith('png') else bmp
+        if size is None:
+            # whole letter page, inked where the content is
+            w, h = int(612*k), int(792*k)
+            data = raster(w,h,(box[0]*k,(792-box[3])*k,box[2]*k+1,(792-box[1])*k+1))
+        else:
+            w, h = size
+            data = raster(w,h)
+        time.sleep(0.002 + 2e-8*w*h)
+    else:
+        data = ('%%!PS-Adobe-3.0 %s\n'%dev).encode() + open(src,'rb').read() + b'\n%%EOF\n'
+        time.sleep(0.005 + 1e-5*len(data))
+    open(out,'wb').write(data)
+    return ''
+
+if args[-1] == '-':
+    # persistent session, jobs are save ... restore blocks followed by printing the marker the caller waits for
+    buf = ''
+    while True:
+        line = sys.stdin.readline()
+        if not line or line.strip() == 'quit': break
+        buf += line
+        if 'flushfile' not in line: continue
+        job, buf = buf, ''
+        dev = re.search(r'\((\w+)\) selectdevice',job).group(1)
+        out = re.search(r'/OutputFile \(([^)]*)\)',job)
+        res = re.search(r'/HWResolution \[(\S+) ',job)
+        ps = re.search(r'/PageSize \[(\S+) (\S+)\]',job)
+        src = re.search(r'\(([^()]*)\) run \}',job).group(1)
+        marker = re.search(r'\((TEXTONIC-JOB-\d+) FAIL',job).group(1)
+        res = float(res.group(1)) if res else 72.0
+        size = [int(round(float(v)*res/72)) for v in ps.groups()] if ps else None
+        err = render(dev,src,out and out.group(1),res,size,None)
+        sys.stdout.write(marker+' OK\n')
+        sys.stdout.flush()
+        sys.stderr.write(err+marker+' OK\n')
+        sys.stderr.flush()
+    sys.exit(0)
+dev = out = size = None
+res = 72.0
+for i, a in enumerate(args):
+    if a.startswith('-sDEVICE='): dev = a[9:]
+    elif a == '-o': out = args[i+1]
+    elif a.startswith('-sOutputFile='): out = a[13:]
+    elif a.startswith('-g'): size = [int(v) for v in a[2:].split('x')]
+    elif a.startswith('-r'): res = float(a[2:].split('x')[0])
+sys.stderr.write(render(dev,args[-1],out,res,size,None))
+'''
+
+def writeStubs(path):
+    # returns the (latex, gs) executables to point TexTonic at
+    exes = []
+    for name, code in (('pdflatex',STUB_LATEX),('gs',STUB_GS)):
+        script = os.path.join(path,name+'-stub.py')
+        open(script,'w').write(code)
+        if os.name == 'nt':
+            exe = os.path.join(path,name+'.bat')
+            open(exe,'w').write('@"%s" "%s" %%*\n'%(sys.executable,script))
+        else:
+            exe = os.path.join(path,name)
+            open(exe,'w').write('#!%s\n'%sys.executable + code)
+            os.chmod(exe,os.stat(exe).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        exes.append(exe)
+    return exes
+
+def percentile(values, p):
+    # nearest-rank, so the result is always one of the measurements
+    values = sorted(values)
+    return values[max(0,int(math.ceil(p/100.0*len(values)))-1)]
+
+def _measure(tex, fn):
+    # run fn as one profiled render, returning (seconds, processes spawned, bytes written)
+    starts = tex.session.starts if tex.session is not None else 0
+    tex.startProfile()
+    try:
+        fn()
+    finally:
+        prof = tex.finishProfile()
+    spawns = sum(1 for s in prof['spans'] if s['cmd'] and not s['cmd'].startswith('session:'))
+    spawns += (tex.session.starts if tex.session is not None else 0) - starts
+    return prof['wall'], spawns, sum(s['bytes'] or 0 for s in prof['spans'])
+
+def runBenchmark(tex, corpus=CORPUS, formats=('EPS','PDF','PNG'), resolutions=(150,300,600), repeat=10, warmup=1, cb=None):
+    # time runLatex, computeBounds and every conversion of each snippet, returning {case: stats}
+    # the render cache should be off, and bounds are forgotten before each conversion so every case does its full work
+    results = {}
+    for name, snippet in corpus:
+        data = textonic.wrapSource(snippet.encode('utf-8'))
+        cases = [('latex',lambda: tex.runLatex(data)),('bounds',lambda: tex.computeBounds('textonic.pdf'))]
+        for fmt in formats:
+            for res in (resolutions if fmt == 'PNG' else [None]):
+                label = fmt.lower() if res is None else '%s@%d'%(fmt.lower(),res)
+                cases.append((label,lambda fmt=fmt, res=res: tex.convert('textonic.pdf',fmt,res=res)))
+        samples = dict((label,[]) for label, fn in cases)
+        for i in range(warmup+repeat):
+            for label, fn in cases:
+                if label != 'latex': tex.bounds.clear()
+                m = _measure(tex,fn)
+                if i >= warmup: samples[label].append(m)
+        for label, fn in cases:
+            times = [m[0] for m in samples[label]]
+            case = '%s/%s'%(name,label)
+            results[case] = {'n':len(times), 'mean':sum(times)/len(times),
+                'p50':percentile(times,50), 'p90':percentile(times,90), 'p99':percentile(times,99),
+                'spawns':max(m[1] for m in samples[label]), 'bytes':max(m[2] for m in samples[label])}
+            if cb is not None: cb(case,results[case])
+    return results
+
+def _legacyDIB(path):
+    # the clipboard bitmap as it used to be made, compositing the PNG onto white with PIL
+    from PIL import Image
+    import StringIO
+    png = Image.open(path)
+    bmp = Image.new('RGB',png.size,(255,255,255))
+    bmp.paste(png,mask=png.split()[3])
+    buffer = StringIO.StringIO()
+    bmp.save(buffer,format='bmp')
+    return buffer.getvalue()[14:]
+
+def _directDIB(path):
+    # the gs bmp16m output less its file header, as clipboard() hands it to SetClipboardData
+    return open(path,'rb').read()[14:]
+
+def _peakChild(fn, path, queue):
+    import resource
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    fn(path)
+    # ru_maxrss is in kilobytes, except on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    queue.put((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-before)*scale)
+
+def peakMemory(fn, path):
+    # how far fn(path) raises the peak resident size of a fresh process, in bytes (None where unsupported)
+    try:
+        import resource
+    except ImportError:
+        return None
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_peakChild,args=(fn,path,queue))
+    proc.start()
+    peak = queue.get()
+    proc.join()
+    return peak
+
+def clipboardMemory(tex, corpus=CORPUS, res=600, cb=None):
+    # peak memory of preparing the clipboard bitmap of each snippet at res, the PIL way and from gs directly
+    results = {}
+    for name, snippet in corpus:
+        tex.runLatex(textonic.wrapSource(snippet.encode('utf-8')))
+        bmp = os.path.join(tex.dir,tex.convert('textonic.pdf','BMP',res=res))
+        r = {'direct':peakMemory(_directDIB,bmp), 'pil':None, 'size':os.path.getsize(bmp)}
+        if textonic.Image is not None:
+            r['pil'] = peakMemory(_legacyDIB,os.path.join(tex.dir,tex.convert('textonic.pdf','PNG',res=res)))
+        results[name] = r
+        if cb is not None: cb(name,r)
+    return results
+
+def compare(results, baseline, tol=0.25, slack=0.002):
+    # cases slower than the baseline median by more than tol (and slack seconds), or spawning/writing more
+    regressions = []
+    for case, r in sorted(results.items()):
+        b = baseline.get(case)
+        if b is None: continue
+        if r['p50'] > b['p50']*(1+tol) + slack:
+            regressions.append('%s: median %.1f ms, was %.1f ms'%(case,1000*r['p50'],1000*b['p50']))
+        if r['spawns'] > b['spawns']:
+            regressions.append('%s: %d processes spawned, was %d'%(case,r['spawns'],b['spawns']))
+        if r['bytes'] > b['bytes']*(1+tol):
+            regressions.append('%s: %d bytes written, was %d'%(case,r['bytes'],b['bytes']))
+    return regressions
+
+def _printCase(case, r):
+    print('%-22s %8.1f %8.1f %8.1f %7d %10d'%(case,1000*r['p50'],1000*r['p90'],1000*r['p99'],r['spawns'],r['bytes']))
+    sys.stdout.flush()
+
+def _printMemory(name, r):
+    kb = lambda v: 'n/a' if v is None else '%d KB'%(v/1024)
+    print('>> %s: %s bitmap, peak memory %s with PIL, %s direct'%(name,kb(r['size']),kb(r['pil']),kb(r['direct'])),file=sys.stderr)
+
+def _describe(config):
+    return ', '.join('%s=%s'%(k,config[k]) for k in sorted(config))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the TexTonic render pipeline')
+    parser.add_argument('-n','--repeat',type=int,default=10,help='measured runs of each case')
+    parser.add_argument('-r','--res',type=int,action='append',help='PNG resolution, may be repeated (default 150, 300 and 600)')
+    parser.add_argument('-f','--format',action='append',choices=['EPS','PDF','PNG'],type=str.upper,help='output format, may be repeated (default all)')
+    parser.add_argument('-s','--snippet',action='append',choices=[name for name, s in CORPUS],help='only run these snippets')
+    parser.add_argument('--tools',choices=['auto','real','stub'],default='auto',help='use the installed pdflatex and gs, the stubs, or the installed ones if found')
+    parser.add_argument('--no-session',dest='persistent',action='store_false',help='run every Ghostscript job in its own process')
+    parser.add_argument('--crop',choices=['bbox','alpha','auto'],help='PNG cropping to measure (default bbox)')
+    parser.add_argument('--memory',type=int,metavar='RES',help='also measure peak memory of making the clipboard bitmap at this resolution')
+    parser.add_argument('--json',help='write the results to this file')
+    parser.add_argument('--baseline',help='compare against results saved with --json, exiting with 1 on regressions or 2 if measured differently')
+    parser.add_argument('--tolerance',type=float,default=0.25,help='allowed slowdown against the baseline (default 0.25)')
+    args = parser.parse_args(argv)
+    tex = textonic.TexTonic()
+    stubs = None
+    real = find_executable(tex.latex) and find_executable(tex.gs)
+    if args.tools == 'real' and not real:
+        parser.error('%s and %s must be on the PATH'%(tex.latex,tex.gs))
+    if args.tools == 'stub' or not real:
+        stubs = tempfile.mkdtemp(prefix='textonic_stubs_')
+        tex.latex, tex.gs = writeStubs(stubs)
+    tex.persistent = args.persistent
+    if args.crop: tex.crop = args.crop
+    tools = 'stub' if stubs else 'real'
+    # everything that changes what is measured, only results with the same settings are comparable
+    config = {'tools':tools, 'session':tex.persistent, 'crop':tex.crop if textonic.Image is not None else 'bbox'}
+    badCrop = []
+    try:
+        corpus = [c for c in CORPUS if not args.snippet or c[0] in args.snippet]
+        print('>> %s tools, %d runs per case'%(tools,args.repeat),file=sys.stderr)
+        print('%-22s %8s %8s %8s %7s %10s'%('case','p50 ms','p90 ms','p99 ms','spawns','bytes'))
+        results = runBenchmark(tex,corpus,args.format or ('EPS','PDF','PNG'),args.res or (150,300,600),args.repeat,cb=_printCase)
+        if textonic.Image is not None:
+            for name, snippet in corpus:
+                tex.runLatex(textonic.wrapSource(snippet.encode('utf-8')))
+                ok, diff = tex.checkCrop('textonic.pdf')
+                print('>> %s: single-pass crop differs by %.2f%%%s'%(name,100*diff,'' if ok else ' (too much)'),file=sys.stderr)
+                if not ok: badCrop.append(name)
+        memory = clipboardMemory(tex,corpus,args.memory,_printMemory) if args.memory else None
+    finally:
+        tex.cleanup()
+        if stubs: shutil.rmtree(stubs,True)
+    record = {'python':platform.python_version(), 'platform':platform.platform(), 'pil':textonic.Image is not None, 'time':time.time(), 'results':results}
+    record.update(config)
+    if memory is not None: record['memory'] = memory
+    if args.json:
+        json.dump(record,open(args.json,'w'),indent=1,sort_keys=True)
+    if badCrop: print('!! Single-pass crop is off for',', '.join(badCrop),file=sys.stderr)
+    if args.baseline:
+        baseline = json.load(open(args.baseline))
+        other = dict((k,baseline.get(k)) for k in config)
+        if other != config:
+            print('!! Baseline was measured with %s, these results with %s'%(_describe(other),_describe(config)),file=sys.stderr)
+            return 2
+        regressions = compare(results,baseline['results'],args.tolerance)
+        for r in regressions: print('!! Regression in',r,file=sys.stderr)
+        if regressions: return 1
+        print('>> No regressions against',args.baseline,file=sys.stderr)
+    return 1 if badCrop else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
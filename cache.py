@@ -0,0 +1,144 @@
+from __future__ import print_function
+import hashlib
+import os
+import shutil
+import sys
+import threading
+
+def userCacheDir(*parts):
+    # somewhere that survives between sessions, following the platform conventions
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+        base = os.path.join(base,'textonic')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+        base = os.path.join(base,'textonic')
+    return os.path.join(base,*parts)
+
+def makeKey(*parts):
+    h = hashlib.sha1()
+    for p in parts:
+        if not isinstance(p,bytes): p = str(p).encode('utf-8')
+        h.update(p)
+        h.update(b'\0')
+    return h.hexdigest()
+
+class RenderCache:
+    # content-addressed store of rendered files, evicted least-recently-used first
+    # each entry is <key>.<ext> plus a <key>.meta holding the time it took to produce
+    def __init__(self,path=None,maxsize=200*1024*1024):
+        self.path = path or userCacheDir('cache')
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0.0    # seconds of process time avoided by hits
+        self.total = None   # bytes stored, kept up to date by put() once a scan has seeded it
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _file(self,key,ext):
+        return os.path.join(self.path,key+'.'+ext.lower())
+
+    def get(self,key,ext,count=True):
+        # auxiliary lookups pass count=False so they don't skew the statistics
+        fn = self._file(key,ext)
+        if not os.path.isfile(fn):
+            if count: self._count(None,ext)
+            return None
+        try:
+            os.utime(fn,None)   # mtime doubles as the LRU timestamp
+        except OSError:
+            pass
+        if count: self._count(fn,ext)
+        return fn
+
+    def _count(self,fn,ext):
+        if fn is None:
+            with self.lock: self.misses += 1
+            return
+        try:
+            cost = float(open(fn[:-len(ext)]+'meta').read())
+        except (OSError,IOError,ValueError):
+            cost = 0.0
+        with self.lock:
+            self.hits += 1
+            self.saved += cost
+
+    def cost(self,key,ext):
+        try:
+            return float(open(self._file(key,ext)[:-len(ext)]+'meta').read())
+        except (OSError,IOError,ValueError):
+            return 0.0
+
+    def fetch(self,key,ext,dest,count=True):
+        fn = self.get(key,ext,False)
+        if fn is not None:
+            try:
+                shutil.copyfile(fn,dest)
+            except (OSError,IOError):
+                fn = None   # evicted by another process since the lookup
+        if count: self._count(fn,ext)
+        return fn is not None
+
+    def put(self,key,ext,src,cost=0.0):
+        fn = self._file(key,ext)
+        tmp = '%s.%d.%d.tmp'%(fn,os.getpid(),threading.current_thread().ident)
+        try:
+            shutil.copyfile(src,tmp)
+            size = os.path.getsize(tmp)
+            if os.path.isfile(fn):
+                size -= os.path.getsize(fn)
+                os.remove(fn)
+            os.rename(tmp,fn)
+            open(fn[:-len(ext)]+'meta','w').write('%.6f'%cost)
+        except (OSError,IOError) as E:
+            # another process may have beaten us to it, which is fine
+            print('!! Failed to store cache entry,',E,file=sys.stderr)
+            if os.path.isfile(tmp): os.remove(tmp)
+            return False
+        with self.lock:
+            if self.total is not None: self.total += size
+            full = self.total is None or self.total > self.maxsize
+        # only list the directory when it may be over budget, or to seed the running total
+        if full: self.evict()
+        return True
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            fn = os.path.join(self.path,name)
+            if name.endswith('.meta') or name.endswith('.tmp'): continue
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            entries.append((st.st_mtime,st.st_size,fn))
+            total += st.st_size
+        entries.sort()
+        while total > self.maxsize and entries:
+            mtime, size, fn = entries.pop(0)
+            try:
+                os.remove(fn)
+                meta = os.path.splitext(fn)[0]+'.meta'
+                if os.path.isfile(meta): os.remove(meta)
+            except OSError:
+                continue
+            total -= size
+        # other processes sharing the directory make the running total drift, so each scan resets it
+        with self.lock: self.total = total
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            try:
+                os.remove(os.path.join(self.path,name))
+            except OSError:
+                pass
+        with self.lock: self.total = None
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits':self.hits, 'misses':self.misses, 'saved':self.saved,
+                    'ratio':float(self.hits)/lookups if lookups else 0.0}
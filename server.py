@@ -0,0 +1,214 @@
+from __future__ import print_function
+import argparse
+import BaseHTTPServer
+import SocketServer
+import json
+import Queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import textonic
+from cache import RenderCache, makeKey
+
+CONTENT_TYPES = {'PNG':'image/png', 'PDF':'application/pdf', 'EPS':'application/postscript', 'BMP':'image/bmp'}
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0]
+MAX_BODY = 1024*1024    # largest request accepted, in bytes
+MAX_RES = 2400          # highest raster resolution accepted, in dpi
+
+class Busy(Exception):
+    pass
+
+class RenderJob(object):
+    # one distinct render, shared by every request for the same output while it is queued or running
+    def __init__(self,key,source,format,res,outline):
+        self.key = key
+        self.source = source
+        self.format = format
+        self.res = res
+        self.outline = outline
+        self.data = None
+        self.error = None
+        self.submitted = time.time()
+        self.done = threading.Event()
+
+class RenderService(object):
+    # renders on a pool of workspaces, queueing at most depth jobs beyond those running
+    def __init__(self,workers=None,depth=32,cache=None,setup=None,res=300):
+        self.pool = textonic.WorkspacePool(workers,setup,res=res,cache=cache)
+        self.cache = cache
+        self.res = res
+        self.queue = Queue.Queue(depth)
+        self.inflight = {}      # job key -> RenderJob, until it completes
+        self.lock = threading.Lock()
+        self.counts = dict(requests=0,deduplicated=0,rejected=0,completed=0,failed=0)
+        self.latency = [0]*(len(BUCKETS)+1)
+        self.latencySum = 0.0
+        self.busy = 0
+        self.threads = []
+        for i in range(self.pool.size):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self,source,format='PNG',res=None,outline=True):
+        # returns the job rendering this output, joining an identical one already in flight
+        # raises Busy if the queue is full
+        if res is None: res = self.res
+        key = makeKey(source,format,res,outline)
+        with self.lock:
+            self.counts['requests'] += 1
+            job = self.inflight.get(key)
+            if job is not None:
+                self.counts['deduplicated'] += 1
+                return job
+            job = RenderJob(key,source,format,res,outline)
+            try:
+                self.queue.put_nowait(job)
+            except Queue.Full:
+                self.counts['rejected'] += 1
+                raise Busy()
+            self.inflight[key] = job
+        return job
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None: return
+            with self.lock: self.busy += 1
+            try:
+                with self.pool.workspace() as tex:
+                    tex.outline = job.outline
+                    job.data = tex.render(textonic.wrapSource(job.source),job.format,res=job.res)
+            except Exception as E:
+                job.error = E
+            elapsed = time.time()-job.submitted
+            with self.lock:
+                self.busy -= 1
+                del self.inflight[job.key]
+                self.counts['failed' if job.error else 'completed'] += 1
+                self.latency[sum(1 for b in BUCKETS if elapsed > b)] += 1
+                self.latencySum += elapsed
+            job.done.set()
+
+    def metrics(self):
+        with self.lock:
+            m = {'queued':self.queue.qsize(), 'depth':self.queue.maxsize, 'running':self.busy,
+                 'workers':self.pool.size, 'inflight':len(self.inflight)}
+            m.update(self.counts)
+            # cumulative, as Prometheus histograms are
+            total = 0
+            buckets = []
+            for bound, n in zip(BUCKETS+['+Inf'],self.latency):
+                total += n
+                buckets.append([bound,total])
+            m['latency'] = {'buckets':buckets, 'count':total, 'sum':self.latencySum}
+        if self.cache is not None: m['cache'] = self.cache.stats()
+        return m
+
+    def close(self):
+        for t in self.threads: self.queue.put(None)
+        self.pool.close()
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # POST /render with {"source": ..., "format": "PNG", "res": 300, "outline": true}, GET /metrics and /health
+    timeout = 120   # longest a request waits for its render
+
+    def _reply(self,code,body,ctype='application/json',headers=()):
+        if not isinstance(body,bytes): body = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type',ctype)
+        self.send_header('Content-Length',str(len(body)))
+        for k, v in headers: self.send_header(k,v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._reply(200,self.server.service.metrics())
+        elif self.path == '/health':
+            self._reply(200,{'status':'ok'})
+        else:
+            self._reply(404,{'error':'Not found'})
+
+    def do_POST(self):
+        if self.path != '/render':
+            return self._reply(404,{'error':'Not found'})
+        try:
+            length = int(self.headers.get('Content-Length',0))
+        except ValueError:
+            return self._reply(400,{'error':'Bad request: invalid Content-Length'})
+        if length > MAX_BODY:
+            return self._reply(413,{'error':'Request larger than %d bytes'%MAX_BODY})
+        try:
+            req = json.loads(self.rfile.read(max(length,0)))
+            source = req['source']
+            if not isinstance(source,bytes): source = source.encode('utf-8')
+            fmt = str(req.get('format','PNG')).upper()
+            res = int(req['res']) if req.get('res') is not None else None
+            outline = bool(req.get('outline',True))
+            if fmt not in CONTENT_TYPES: raise ValueError('Unknown format %s'%fmt)
+            if res is not None and not 0 < res <= MAX_RES: raise ValueError('res must be between 1 and %d'%MAX_RES)
+        except (ValueError,KeyError,TypeError) as E:
+            return self._reply(400,{'error':'Bad request: %s'%E})
+        try:
+            job = self.server.service.submit(source,fmt,res,outline)
+        except Busy:
+            return self._reply(429,{'error':'Too many queued renders'},headers=[('Retry-After','1')])
+        if not job.done.wait(self.timeout):
+            return self._reply(504,{'error':'Render timed out'})
+        if isinstance(job.error,textonic.LatexError):
+            self._reply(422,{'error':job.error.message,'line':textonic.snippetLine(source,job.error.line),'context':job.error.context})
+        elif job.error is not None:
+            self._reply(500,{'error':str(job.error) or job.error.__class__.__name__})
+        else:
+            self._reply(200,job.data,CONTENT_TYPES[fmt])
+
+    def log_message(self,format,*args):
+        print('>>',self.address_string(),format%args,file=sys.stderr)
+
+class RenderServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self,address,service):
+        BaseHTTPServer.HTTPServer.__init__(self,address,Handler)
+        self.service = service
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve LaTeX renders over HTTP on this machine')
+    parser.add_argument('--host',default='127.0.0.1',help='address to listen on')
+    parser.add_argument('-p','--port',type=int,default=8765,help='port to listen on')
+    parser.add_argument('-j','--workers',type=int,default=None,help='renders to run at once (default: one per core)')
+    parser.add_argument('-q','--depth',type=int,default=32,help='renders to queue before answering 429')
+    parser.add_argument('-r','--res',type=int,default=300,help='default raster resolution in dpi')
+    parser.add_argument('--no-cache',dest='cache',action='store_false',help='disable the render cache')
+    parser.add_argument('--latex',help='LaTeX executable')
+    parser.add_argument('--gs',help='Ghostscript executable')
+    parser.add_argument('--stub-tools',action='store_true',help='render with the benchmark stand-ins for pdflatex and gs, for testing offline')
+    args = parser.parse_args(argv)
+    stubs = None
+    if args.stub_tools:
+        import bench
+        stubs = tempfile.mkdtemp(prefix='textonic_stubs_')
+        args.latex, args.gs = bench.writeStubs(stubs)
+    def setup(tex):
+        if args.latex: tex.latex = args.latex
+        if args.gs: tex.gs = args.gs
+    service = RenderService(args.workers,args.depth,RenderCache() if args.cache else None,setup,args.res)
+    server = RenderServer((args.host,args.port),service)
+    print('>> Listening on http://%s:%d/ with %d workers'%(args.host,server.server_address[1],service.pool.size),file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if stubs: shutil.rmtree(stubs,True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,121 +4,987 @@ import tempfile
 import os
 import shutil
 import sys
-import StringIO
+import time
+import threading
+import Queue
+import multiprocessing
+import collections
+import json
+import atexit
+import weakref
+import contextlib
+import re
+from multiprocessing.pool import ThreadPool
+import struct
+import math
+from cache import makeKey, userCacheDir
+try:
+    from PIL import Image, ImageChops
+except ImportError:
+    Image = None
+
+# every TexTonic still alive, so none of their latex or gs processes outlive us
+_live = weakref.WeakSet()
+
+def _cleanupAll():
+    for tex in list(_live):
+        tex.cleanup()
+
+atexit.register(_cleanupAll)
+
+def _toolStamp(exe):
+    # identify an executable by location, size and modification time, so that upgrades invalidate caches
+    path = exe
+    if not os.path.dirname(exe):
+        exts = os.environ.get('PATHEXT','.EXE').split(os.pathsep) if os.name == 'nt' else ['']
+        for d in os.environ.get('PATH','').split(os.pathsep):
+            for e in exts:
+                if os.path.isfile(os.path.join(d,exe+e)):
+                    path = os.path.join(d,exe+e)
+                    break
+            else: continue
+            break
+    try:
+        st = os.stat(path)
+    except OSError:
+        return exe
+    return '%s:%d:%d'%(os.path.abspath(path),st.st_mtime,st.st_size)
+
+def splitSnippet(data):
+    # separate the %! preamble lines of a bare snippet from its body
+    preamble = r"""
+        \documentclass{article}
+        \usepackage{amsmath,amssymb}
+        \pagestyle{empty}
+    """
+    mainmatter = ''
+    for l in data.split('\n'):
+        if l.startswith('%!'):
+            preamble += l[2:] + '\n'
+        else:
+            mainmatter += l + '\n'
+    return preamble, mainmatter
+
+def wrapSource(data):
+    # bare snippets get a minimal document around them, with any %! lines added to the preamble
+    if r'\begin{document}' in data or r'\documentclass' in data:
+        return data
+    preamble, mainmatter = splitSnippet(data)
+    return preamble + '\\begin{document}\n' + mainmatter + '\\end{document}\n'
+
+# anything that can make TeX read (or write out) spaces, line ends or % literally, matched in lower case
+# so Verbatim, \Verb and friends are caught too
+_LITERAL = ('\\verb','verbatim','lstlisting','\\lstinline','minted','\\mint','alltt','\\catcode',
+            '\\obeyspaces','\\obeylines','\\string','\\detokenize','\\url','\\path','\\href','filecontents')
+
+def normalizeSource(data):
+    # what TeX actually reads: comments (by the editor's highlighting rule) dropped with their line end,
+    # leading and trailing spaces dropped, other line ends and runs of spaces made one space, and blank lines merged
+    # anything that might read its text literally is left alone, since there every character counts
+    low = data.lower()
+    if any(s in low for s in _LITERAL):
+        return data
+    out = []
+    for line in data.split('\n'):
+        idx = -1
+        while 1:
+            idx = line.find('%',idx+1)
+            if idx < 0 or idx == 0 or line[idx-1] != '\\': break
+        if idx >= 0:
+            out.append(line[:idx].lstrip(' \t\r'))
+        elif line.strip(' \t\r'):
+            out.append(line.strip(' \t\r')+' ')
+        else:
+            out.append('\n\n')   # paragraph break
+    data = re.sub(r'\n{3,}','\n\n',re.sub(r'[ \t]+',' ',''.join(out)))
+    # spaces and breaks either side of \begin{document} or \end{document} never reach the page
+    return re.sub(r'\s*(\\(?:begin|end)\{document\})\s*',r'\1',data)
+
+def fingerprint(data, *settings):
+    # identifies the output a render of data would give, so edits that can't change it are skipped
+    return makeKey(normalizeSource(data),*settings)
+
+def snippetLine(data, line):
+    # map a line of wrapSource(data) back to a line of data, or None if it is in the generated preamble
+    if line is None or r'\begin{document}' in data or r'\documentclass' in data:
+        return line
+    preamble, mainmatter = splitSnippet(data)
+    n = line - (preamble+'\\begin{document}\n').count('\n') - 1
+    if n < 0: return None
+    for i, l in enumerate(data.split('\n')):
+        if l.startswith('%!'): continue
+        if n == 0: return i+1
+        n -= 1
+    return None
+
+class LatexError(RuntimeError):
+    # the first error TeX reported, with the source line it was on (if known) and the text it had read there
+    def __init__(self, message, line=None, context=''):
+        RuntimeError.__init__(self, message if line is None else 'Line %d: %s'%(line,message))
+        self.message = message
+        self.line = line
+        self.context = context
+
+class LatexLog:
+    # picks the first error out of TeX output as it streams in, i.e.
+    #   ! Undefined control sequence.
+    #   l.5 \foo
+    def __init__(self, offset=0):
+        self.offset = offset    # lines of the document TeX didn't see, such as a precompiled preamble
+        self.message = None
+        self.line = None
+        self.context = ''
+        self.pending = 0
+        self.done = False
+        
+    def feed(self, line):
+        # returns True once the error is complete, so the run can be stopped
+        if self.done: return False
+        if self.message is None:
+            if line.startswith('! '): self.message = line[2:].strip()
+            return False
+        self.pending += 1
+        if line.startswith('l.'):
+            num, sep, context = line[2:].partition(' ')
+            if num.isdigit():
+                self.line = int(num) + self.offset
+                self.context = context
+                self.done = True
+        # some errors (emergency stops, missing files) never say where they are
+        elif self.pending >= 20:
+            self.done = True
+        return self.done
+        
+    def error(self):
+        if self.message is None: return None
+        return LatexError(self.message,self.line,self.context)
+
+def _drainLines(stream,put):
+    for line in iter(stream.readline,''):
+        put(line.rstrip())
+    put(None)
+
+def _waitChild(pipe):
+    # wait for a child process, returning its exit code and the CPU time it used (None if unknown)
+    if os.name == 'nt':
+        import ctypes
+        from ctypes import wintypes
+        code = pipe.wait()
+        times = [wintypes.FILETIME() for i in range(4)]
+        if not ctypes.windll.kernel32.GetProcessTimes(int(pipe._handle),*[ctypes.byref(t) for t in times]):
+            return code, None
+        return code, sum((t.dwHighDateTime<<32 | t.dwLowDateTime) for t in times[2:])*1e-7
+    try:
+        pid, status, usage = os.wait4(pipe.pid,0)
+    except OSError:
+        return pipe.wait(), None
+    pipe.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return pipe.returncode, usage.ru_utime + usage.ru_stime
+
+def fastTempDir():
+    # a RAM-backed place for the scratch files where the system has one, otherwise the default temp dir
+    if os.name != 'nt' and os.path.isdir('/dev/shm') and os.access('/dev/shm',os.W_OK):
+        return '/dev/shm'
+    return None
+
+def _popenArgs():
+    # http://stackoverflow.com/questions/7006238/how-do-i-hide-the-console-when-i-use-os-system-or-subprocess-call
+    if os.name != 'nt': return {}
+    startupinfo = subprocess.STARTUPINFO()
+    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    return {'startupinfo':startupinfo}
+
+# capabilities of each executable, keyed on _toolStamp and persisted in userCacheDir('tools.json')
+_tools = None
+_toolsLock = threading.Lock()
+
+def _loadTools():
+    global _tools
+    if _tools is None:
+        try:
+            _tools = json.load(open(userCacheDir('tools.json')))
+        except (IOError,OSError,ValueError):
+            _tools = {}
+    return _tools
+
+def _saveTools():
+    fn = userCacheDir('tools.json')
+    tmp = '%s.%d.tmp'%(fn,os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(fn)): os.makedirs(os.path.dirname(fn))
+        json.dump(_tools,open(tmp,'w'),indent=1,sort_keys=True)
+        if os.path.isfile(fn): os.remove(fn)
+        os.rename(tmp,fn)
+    except (IOError,OSError) as E:
+        print('!! Failed to store toolchain record,',E,file=sys.stderr)
+
+def _probeTool(exe,kind):
+    def run(arg,check=True):
+        pipe = subprocess.Popen([exe,arg],stdout=subprocess.PIPE,stderr=subprocess.STDOUT,**_popenArgs())
+        out = pipe.communicate()[0].decode('utf-8','replace')
+        if check and pipe.returncode:
+            raise subprocess.CalledProcessError(pipe.returncode,exe+' '+arg)
+        return out
+    if kind == 'latex':
+        return {'version':run('--version').strip().split('\n')[0]}
+    version = run('-v').strip().split('\n')[0]
+    # the device list is the indented block after 'Available devices:'
+    devices = []
+    lines = run('-h',False).split('\n')
+    for i, l in enumerate(lines):
+        if l.strip() != 'Available devices:': continue
+        for l in lines[i+1:]:
+            if not l[:1].isspace(): break
+            devices += l.split()
+        break
+    epsdev = 'eps2write' if 'eps2write' in devices else 'epswrite' if 'epswrite' in devices else None
+    # eps2write outlines fonts with a device parameter, epswrite only with the font cache disabled
+    outline = {'eps2write':'NoOutputFonts', 'epswrite':'NOCACHE'}.get(epsdev)
+    return {'version':version, 'devices':devices, 'epsdev':epsdev, 'outline':outline}
+
+def toolInfo(exe,kind,refresh=False):
+    # version and capabilities of a 'latex' or 'gs' executable, probed once and remembered until it changes
+    # raises OSError or CalledProcessError if it can't be run
+    stamp = _toolStamp(exe)
+    with _toolsLock:
+        rec = _loadTools().get(stamp)
+    if rec is not None and not refresh: return rec
+    rec = _probeTool(exe,kind)
+    rec.update(path=exe,kind=kind,checked=time.time())
+    if stamp != exe:    # only remember executables we could find on disk
+        with _toolsLock:
+            tools = _loadTools()
+            # forget older versions of this executable, and any that have since been removed
+            for k in [k for k, v in tools.items() if v.get('path') == exe or not os.path.exists(k.rsplit(':',2)[0])]: del tools[k]
+            tools[stamp] = rec
+            _saveTools()
+    return rec
+
+def knownTool(exe):
+    # the remembered record for exe if it hasn't changed since it was probed, without running it
+    with _toolsLock:
+        return _loadTools().get(_toolStamp(exe))
+
+def _psString(s):
+    return '(' + s.replace('\\','/').replace('(','\\(').replace(')','\\)') + ')'
+
+def _psValue(v):
+    if v is True or v is False: return str(v).lower()
+    if isinstance(v,(list,tuple)): return '[' + ' '.join(_psValue(x) for x in v) + ']'
+    if isinstance(v,float): return '%.4f'%v
+    return str(v)
+
+class GhostscriptSession:
+    # a long-lived gs process fed jobs over stdin, so each conversion avoids gs startup and font init
+    # writing files requires the -dSAFER permit lists, i.e. Ghostscript 9.50 or later
+    def __init__(self,gs,dir):
+        self.gs = gs
+        self.dir = dir
+        self.proc = None
+        self.jobs = 0
+        self.starts = 0             # processes launched, as the session restarts after failures
+        self.unsupported = set()    # devices that failed in the session, which we leave to one-shot runs
+        self.working = False        # whether any job has succeeded, otherwise gs probably can't run a session
+        self.disabled = False
+        self.killed = False
+        self.lock = threading.Lock()
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        self.close()
+        self.killed = False
+        perm = self.dir.replace('\\','/').rstrip('/') + '/*'
+        args = [self.gs,'-dNOPAUSE','-dSAFER','-q','-dNOPROMPT','--permit-file-read='+perm,'--permit-file-write='+perm,'-']
+        self.proc = subprocess.Popen(args,stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.PIPE,cwd=self.dir,shell=False,**_popenArgs())
+        self.starts += 1
+        self.queue = Queue.Queue()
+        for name, stream in (('out',self.proc.stdout),('err',self.proc.stderr)):
+            t = threading.Thread(target=self._reader,args=(name,stream))
+            t.daemon = True
+            t.start()
+        print('>> started',args,file=sys.stderr)
+
+    def _reader(self,name,stream):
+        for line in iter(stream.readline,''):
+            self.queue.put((name,line.rstrip()))
+        self.queue.put((name,None))
+
+    def run(self,setup,src,timeout=60):
+        # returns the stderr output of the job, or None if it failed
+        # timeout is how long to wait for a hung interpreter, or None to wait as a one-shot process would
+        if not self.alive(): self.start()
+        self.jobs += 1
+        marker = 'TEXTONIC-JOB-%d'%self.jobs
+        # the restore closes the device, which is when pdfwrite and eps2write finish the file,
+        # so the marker only goes out after it, keeping just the job's status across it
+        ps = ['/TexTonicSave save def',
+              '{ %s %s run } stopped'%(setup,_psString(src)),
+              'count 1 sub { exch pop } repeat cleardictstack TexTonicSave restore',
+              '{ (%s FAIL\n) } { (%s OK\n) } ifelse'%(marker,marker),
+              'dup print flush (%stderr) (w) file dup 3 -1 roll writestring flushfile','']
+        try:
+            self.proc.stdin.write('\n'.join(ps))
+            self.proc.stdin.flush()
+        except (IOError,OSError):
+            if not self.killed: self.disabled = not self.working
+            self.close()
+            return None
+        # wait for the marker on both streams, so that everything the job wrote has arrived
+        status = {}
+        err = []
+        deadline = time.time() + timeout if timeout is not None else None
+        while len(status) < 2:
+            try:
+                name, line = self.queue.get(timeout=max(deadline-time.time(),0.01) if deadline is not None else None)
+            except Queue.Empty:
+                line = None
+            if line is None:
+                # dead or hung, so restart on the next job unless it never worked at all
+                if not self.killed: self.disabled = not self.working
+                self.close()
+                return None
+            if line.split(' ')[0] == marker:
+                status[name] = line.endswith('OK')
+            elif name == 'err':
+                err.append(line)
+        print('>> session',setup,src,file=sys.stderr)
+        self.working = True
+        return '\n'.join(err) if all(status.values()) else None
+
+    def kill(self):
+        # abandon the current job from another thread, the session restarts on the next one
+        proc = self.proc
+        if proc is None: return
+        self.killed = True
+        try:
+            proc.terminate()
+        except OSError:
+            pass
+
+    def close(self):
+        if self.proc is None: return
+        try:
+            self.proc.stdin.write('quit\n')
+            self.proc.stdin.close()
+        except (IOError,OSError):
+            pass
+        for i in range(20):
+            if self.proc.poll() is not None: break
+            time.sleep(0.01)
+        else:
+            self.proc.terminate()
+        self.proc = None
+
+def _gsStage(dev):
+    if dev.startswith('png') or dev.startswith('bmp'): return 'raster'
+    return {'eps2write':'eps', 'epswrite':'eps', 'pdfwrite':'pdf'}.get(dev,dev)
+
+def _checkOutput(dev,path,size=None):
+    # sanity check a file written by the session before trusting it
+    try:
+        f = open(path,'rb')
+    except IOError:
+        return False
+    with f:
+        head = f.read(26)
+        f.seek(0,2)
+        f.seek(max(f.tell()-64,0))
+        tail = f.read()
+    if dev.startswith('png'):
+        if head[:8] != '\x89PNG\r\n\x1a\n' or 'IEND' not in tail: return False
+        if size is not None and struct.unpack('>II',head[16:24]) != tuple(size): return False
+        return True
+    if dev.startswith('bmp'):
+        # BITMAPFILEHEADER then BITMAPINFOHEADER, bottom-up rows so the height is positive
+        if len(head) < 26 or head[:2] != 'BM': return False
+        if size is not None and struct.unpack('<ii',head[18:26]) != tuple(size): return False
+        return True
+    return '%%EOF' in tail
+
+def rasterDiff(a, b, shift=1):
+    # mean absolute alpha difference (0..1) over the inked area of two crops, at the best alignment within +-shift pixels
+    a, b = a.split()[3], b.split()[3]
+    w, h = max(a.size[0],b.size[0])+2*shift, max(a.size[1],b.size[1])+2*shift
+    pa = Image.new('L',(w,h))
+    pa.paste(a,(shift,shift))
+    best = None
+    for dx in range(2*shift+1):
+        for dy in range(2*shift+1):
+            pb = Image.new('L',(w,h))
+            pb.paste(b,(dx,dy))
+            hist = ImageChops.difference(pa,pb).histogram()
+            inked = w*h - ImageChops.lighter(pa,pb).histogram()[0]
+            diff = sum(i*n for i, n in enumerate(hist)) / (255.0*max(inked,1))
+            if best is None or diff < best: best = diff
+    return best
+
+def profileSummary(prof):
+    # one line breakdown of a render profile, e.g. 'latex 310 ms, bbox 25 ms, raster 80 ms (412 ms total)'
+    stages = collections.OrderedDict()
+    for span in prof['spans']:
+        name = span['stage'] + (' (cached)' if span['cache'] == 'hit' else '')
+        if span['cache'] == 'miss': continue
+        stages[name] = stages.get(name,0.0) + span['wall']
+    parts = ['%s %.0f ms'%(k,1000*v) for k, v in stages.items()]
+    return '%s (%.0f ms total)'%(', '.join(parts) or 'nothing to do',1000*prof.get('wall',0))
 
 class TexTonic:
-    def __init__(self,res=300):
-        self.dir = tempfile.mkdtemp(prefix='textonic_')
+    def __init__(self,res=300,cache=None,tmpdir=None):
+        # every intermediate file lives in self.dir, on tmpfs where available so they never touch the disk
+        self.dir = tempfile.mkdtemp(prefix='textonic_',dir=tmpdir or fastTempDir())
         self.gs = 'gswin32c' if os.name == 'nt' else 'gs'
         self.epsdev = None
         self.latex = 'pdflatex'
         self.res = res
         self.outline = True
+        self.cache = cache  # optional RenderCache shared between instances
+        self.keys = {}      # cache key of the source behind each generated file
+        self.precompile = True
+        self.formats = {}   # preamble hash -> (format name, preamble load time) or None if unusable
+        self.fmtSaved = 0.0 # total preamble loading time avoided by precompiled formats
+        self.fmtWorked = set()  # formats that have compiled a document, so later failures are the body's fault
+        self.maxFormats = 32    # preambles a recycled workspace keeps formats for
+        self.pipes = set()      # running child processes, so they can be terminated from any thread
+        self.lock = threading.Lock()
+        self.bounds = {}        # source cache key -> bbox, shared by every format converted from it
+        self.aborted = False
+        self.logInterval = 0.1  # how often output is passed to log callbacks, in seconds
+        self.logLines = 500     # or sooner, if this many lines are waiting
+        self.profile = None     # the render being profiled, see startProfile
+        self.profiles = collections.deque(maxlen=20)
+        self.profileLog = None  # file to append finished profiles to, as JSON lines
+        self.persistent = True
+        self.crop = 'bbox'      # PNG cropping: 'bbox' pass, or opt in to 'alpha' of a single full-page render, or 'auto'
+        self.alphaMaxRes = 300  # under 'auto', above this the full-page raster costs more than the bbox pass saves
+        self.session = None
+        _live.add(self)
 
     def __del__(self):
         self.cleanup()
         
-    def _baseGS(self,res=None):
-        if res is None: res = self.res
-        return [self.gs,'-dBATCH','-dNOPAUSE','-dSAFER','-dTextAlphaBits=4','-dGraphicsAlphaBits=4','-r%d'%res]
-        
-    def _exec(self,args,cb=None):
-        # http://stackoverflow.com/questions/7006238/how-do-i-hide-the-console-when-i-use-os-system-or-subprocess-call
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        self.pipe = subprocess.Popen(args,stdout=subprocess.PIPE,stderr=subprocess.PIPE,cwd=self.dir,shell=False,startupinfo=startupinfo)
-        if cb is not None:
-            for line in iter(self.pipe.stdout.readline,''):
-                cb(line.rstrip())
-        code = self.pipe.wait()
+    def abort(self):
+        # stop the render in progress from any thread, the interrupted call raises RuntimeError
+        # the caller clears self.aborted before starting the next one
+        self.aborted = True
+        with self.lock: pipes = list(self.pipes)
+        for pipe in pipes:
+            try:
+                pipe.terminate()
+            except OSError:
+                pass    # already exited
+        if self.session is not None: self.session.kill()
+        
+    def startProfile(self, name=''):
+        # collect a span for each stage of the next render, until finishProfile
+        self.profile = {'name':name, 'start':time.time(), 'spans':[]}
+        
+    def finishProfile(self):
+        prof, self.profile = self.profile, None
+        if prof is None: return None
+        prof['wall'] = time.time() - prof['start']
+        self.profiles.append(prof)
+        if self.profileLog:
+            with self.lock: open(self.profileLog,'a').write(json.dumps(prof)+'\n')
+        return prof
+        
+    def getProfiles(self, n=None):
+        # the most recent n (default all kept) render profiles, oldest first
+        profiles = list(self.profiles)
+        return profiles[-n:] if n else profiles
+        
+    def _span(self, stage, wall, cmd=None, cpu=None, code=None, output=None, cache=None):
+        if self.profile is None: return
+        try:
+            size = os.path.getsize(os.path.join(self.dir,output)) if output else None
+        except OSError:
+            size = None
+        self.profile['spans'].append({'stage':stage, 'cmd':cmd, 'wall':wall, 'cpu':cpu, 'code':code, 'bytes':size, 'cache':cache})
+        
+    def _exec(self,args,cb=None,errcb=None,stage=None,output=None,watch=None):
+        # stdout is passed to cb in batches of lines joined by newlines, at most logInterval seconds or logLines lines apart
+        # stderr is collected in memory and handed to errcb once the process has exited
+        # watch sees each line of stdout as it arrives, and terminates the process by returning True
+        # the run is recorded in the current profile as stage, with the size of the output file
+        if self.aborted: raise RuntimeError('Cancelled')
+        start = time.time()
+        pipe = subprocess.Popen(args,stdout=subprocess.PIPE,stderr=subprocess.PIPE,cwd=self.dir,shell=False,**_popenArgs())
+        with self.lock: self.pipes.add(pipe)
+        try:
+            # drain both pipes from their own threads, so neither can fill up and stall the child
+            lines = Queue.Queue()
+            err = []
+            readers = [threading.Thread(target=_drainLines,args=(pipe.stdout,lines.put)),
+                       threading.Thread(target=lambda: err.append(pipe.stderr.read()))]
+            for t in readers:
+                t.daemon = True
+                t.start()
+            batch = []
+            deadline = None
+            done = stopped = False
+            while not done:
+                try:
+                    line = lines.get(timeout=None if deadline is None else max(deadline-time.time(),0))
+                    if line is None:
+                        done = True
+                    else:
+                        batch.append(line)
+                        if deadline is None: deadline = time.time() + self.logInterval
+                        if watch is not None and not stopped and watch(line):
+                            stopped = True
+                            try:
+                                pipe.terminate()
+                            except OSError:
+                                pass    # already exited
+                except Queue.Empty:
+                    pass
+                if batch and (done or len(batch) >= self.logLines or time.time() >= deadline):
+                    if cb is not None: cb('\n'.join(batch))
+                    batch = []
+                    deadline = None
+            code, cpu = _waitChild(pipe)
+            for t in readers: t.join()
+            if errcb is not None: errcb(''.join(err))
+        finally:
+            with self.lock: self.pipes.discard(pipe)
         print('>>',args,file=sys.stderr)
+        self._span(stage or os.path.basename(args[0]),time.time()-start,' '.join(args),cpu,code,output)
         return code
         
-    def computeBounds(self, src, res=1200):
-        if self._exec(self._baseGS()+['-sDEVICE=bbox',src]):
-            self.finished.emit('Ghostscript BBOX failed')
-            return False
-        bboxinfo = self.pipe.stderr.read()
-        self.pipe = None # close the pipe
+    def _gsSession(self, dev, src, dest, res, params, size, offset):
+        if self.session is None or self.session.gs != self.gs:
+            # the executable changed, so the old interpreter has to go
+            if self.session is not None: self.session.close()
+            self.session = GhostscriptSession(self.gs,self.dir)
+        if self.session.disabled or dev in self.session.unsupported or not self.session.lock.acquire(False):
+            return None
+        try:
+            pdict = ['/OutputFile',_psString(os.path.join(self.dir,dest))] if dest else []
+            if res is not None: pdict += ['/HWResolution',_psValue([res,res]),'/TextAlphaBits 4 /GraphicsAlphaBits 4']
+            for k, v in params: pdict += ['/'+k,_psValue(v)]
+            if size is not None:
+                # fixed media, as -g implies on the command line
+                scale = 72.0/res if res is not None else 1.0
+                pdict += ['/PageSize',_psValue([size[0]*scale,size[1]*scale]),'/Policies << /PageSize 7 >>']
+            if offset is not None:
+                pdict.append('/Install {-%.2f -%.2f translate}'%tuple(offset))
+            setup = '(%s) selectdevice << %s >> setpagedevice'%(dev,' '.join(pdict))
+            if dest and os.path.isfile(os.path.join(self.dir,dest)): os.remove(os.path.join(self.dir,dest))
+            start = time.time()
+            # rasters of big pages at high resolution can legitimately run for minutes, and abort() still stops them
+            err = self.session.run(setup,os.path.join(self.dir,src),None if _gsStage(dev) == 'raster' else 60)
+            self._span(_gsStage(dev),time.time()-start,'session: '+setup,code=0 if err is not None else 1,output=dest)
+            if err is not None and (dest is None or _checkOutput(dev,os.path.join(self.dir,dest),size)):
+                return err
+            if self.session.alive():
+                # the session ran but produced the wrong thing, so don't use it for this device again
+                self.session.unsupported.add(dev)
+        finally:
+            self.session.lock.release()
+        return None
+        
+    def _gs(self, dev, src, dest=None, res=None, params=(), flags=(), size=None, offset=None, page=None, cb=None):
+        # run one Ghostscript job, in the persistent session where possible
+        # size is the fixed page size, in pixels for raster jobs and points otherwise
+        # returns the stderr output (where bbox reports), or None on failure
+        if page is not None:
+            # page selection is an interpreter option, so these can't go through the session
+            flags = list(flags) + ['-dFirstPage=%d'%page,'-dLastPage=%d'%page]
+        if self.persistent and not flags:
+            err = self._gsSession(dev,src,dest,res,params,size,offset)
+            if err is not None: return err
+        # fall back to a one-shot process
+        args = [self.gs,'-dBATCH','-dNOPAUSE','-dSAFER']
+        if res is not None: args += ['-dTextAlphaBits=4','-dGraphicsAlphaBits=4','-r%d'%res]
+        args += list(flags)
+        if dest: args += ['-o',dest]
+        args.append('-sDEVICE='+dev)
+        for k, v in params: args.append('-d%s'%k if v is True else '-d%s=%s'%(k,v))
+        # these need to go AFTER the device specification
+        if size is not None and res is not None: args.append('-g%dx%d'%tuple(size))
+        elif size is not None: args += ['-dDEVICEWIDTHPOINTS=%g'%size[0],'-dDEVICEHEIGHTPOINTS=%g'%size[1],'-dFIXEDMEDIA']
+        if offset is not None: args += ['-c','<</Install {-%.2f -%.2f translate}>> setpagedevice'%tuple(offset)]
+        err = []
+        if self._exec(args+['-f',src],cb,err.append,_gsStage(dev),dest): return None
+        return ''.join(err)
+        
+    def computeBounds(self, src, res=1200, page=None):
+        key = self.keys.get(src)
+        if key is not None: key = (key,page)
+        if key in self.bounds: return self.bounds[key]
+        bboxinfo = self._gs('bbox',src,res=self.res,page=page)
+        if bboxinfo is None:
+            raise RuntimeError('Ghostscript BBOX failed')
         # find the highres info
         for l in bboxinfo.split('\n'):
             if l.startswith('%%HiResBoundingBox:'):
-                return [float(x) for x in l.split(' ')[1:5]]
+                bbox = [float(x) for x in l.split(' ')[1:5]]
+                if key is not None: self.bounds[key] = bbox
+                return bbox
         raise RuntimeError('Failed to compute bounding box')
         
-    def runLatex(self, data, cb=None):
-        src = 'textonic.tex'
-        dest = 'textonic.pdf'
+    def fitResolution(self, src, width, height, minres=72):
+        # highest resolution up to self.res at which src fits in width x height pixels, but no lower than minres
+        bbox = self.computeBounds(src)
+        w, h = max(bbox[2]-bbox[0],1.0), max(bbox[3]-bbox[1],1.0)
+        return int(max(minres,min(self.res,72.0*width/w,72.0*height/h)))
+        
+    def _format(self, preamble, cb=None):
+        # dump the preamble into a format file once, so subsequent runs only process the body
+        key = makeKey('format',_toolStamp(self.latex),preamble)
+        if key in self.formats: return self.formats[key]
+        name = 'pre_'+key[:16]
+        pfmt = os.path.join(self.dir,name+'.fmt')
+        cost = self.cache.cost(key,'fmt') if self.cache is not None and self.cache.fetch(key,'fmt',pfmt) else None
+        if cost is None:
+            open(os.path.join(self.dir,name+'.tex'),'wb').write(preamble+'\\dump\n')
+            engine = os.path.splitext(os.path.basename(self.latex))[0]
+            t = time.time()
+            if self._exec([self.latex,'-ini','-interaction=nonstopmode','-jobname='+name,'&'+engine,name+'.tex'],stage='format',output=name+'.fmt') or not os.path.isfile(pfmt):
+                # an aborted dump says nothing about the preamble, so try it again next time
+                if self.aborted: raise RuntimeError('Cancelled')
+                if cb is not None: cb('>> Failed to precompile preamble, using normal compilation')
+                self.formats[key] = None
+                return None
+            cost = time.time()-t
+            if self.cache is not None: self.cache.put(key,'fmt',pfmt,cost)
+        self.formats[key] = (key,name,cost)
+        return self.formats[key]
+        
+    def runLatex(self, data, cb=None, name='textonic', halt=True):
+        # with halt, LaTeX is stopped at the first error, which is raised as a LatexError
+        src = name+'.tex'
+        dest = name+'.pdf'
         # create the tex file
         psrc = os.path.join(self.dir,src)
         pdest = os.path.join(self.dir,dest)
-        open(psrc,'wb').write(data)
+        plog = os.path.join(self.dir,name+'.log')
         if os.path.isfile(pdest): os.remove(pdest)
-        if self._exec([self.latex,'-interaction=nonstopmode',src],cb):
-            raise RuntimeError('LaTeX failed')
+        key = makeKey('latex',_toolStamp(self.latex),data)
+        self.keys.pop(dest,None)
+        start = time.time()
+        if self.cache is not None and self.cache.fetch(key,'pdf',pdest):
+            if cb is not None: cb('>> Using cached '+dest)
+            self._span('latex',time.time()-start,output=dest,cache='hit')
+            self.cache.fetch(key,'log',plog,False)
+            self.keys[dest] = key
+            return dest
+        if self.cache is not None: self._span('latex',time.time()-start,cache='miss')
+        # use a precompiled format if the document has a standard preamble
+        idx = data.find('\\begin{document}')
+        fmt = bad = None
+        if self.precompile and idx > 0 and '\\documentclass' in data[:idx]:
+            fmt = self._format(data[:idx],cb)
+        t = time.time()
+        flags = ['-interaction=nonstopmode'] + (['-halt-on-error'] if halt else [])
+        # without halt the log is still read for the first error, but LaTeX runs on past it
+        watch = lambda line: log.feed(line) and halt
+        if fmt is not None:
+            open(psrc,'wb').write(data[idx:])
+            log = LatexLog(data[:idx].count('\n'))
+            if self._exec([self.latex]+flags+['&'+fmt[1],src],cb,stage='latex',output=dest,watch=watch) == 0:
+                self.fmtSaved += fmt[2]
+                self.fmtWorked.add(fmt[0])
+                if cb is not None: cb('>> Used precompiled preamble, saving ~%.0f ms'%(1000*fmt[2]))
+            elif self.aborted:
+                raise RuntimeError('Cancelled')
+            elif fmt[0] in self.fmtWorked:
+                # the format is known to be good, so the mistake is in the document
+                raise log.error() or RuntimeError('LaTeX failed')
+            else:
+                # some packages do not survive being dumped, so retry the slow way before giving up
+                bad, fmt = fmt, None
+        if fmt is None:
+            open(psrc,'wb').write(data)
+            log = LatexLog()
+            if self._exec([self.latex]+flags+[src],cb,stage='latex',output=dest,watch=watch):
+                raise log.error() or RuntimeError('LaTeX failed')
+            if bad is not None: self.formats[bad[0]] = None
+        if not os.path.isfile(pdest):
+            raise RuntimeError('LaTeX produced no output')
+        if self.cache is not None:
+            self.cache.put(key,'pdf',pdest,time.time()-t)
+            if os.path.isfile(plog): self.cache.put(key,'log',plog)
+        self.keys[dest] = key
         return dest
         
-    def convert(self, src, fmt, cb=None):
-        gscmd = self._baseGS()
-        gsextra = []
+    def convert(self, src, fmt, cb=None, res=None, dest=None, page=None):
+        # the output depends only on the source, the conversion settings and the gs build
+        if res is None: res = self.res
+        key = self.keys.get(src) or makeKey(open(os.path.join(self.dir,src),'rb').read())
         if fmt in ('PNG',2):
-            dest = 'output.png'
-            dev = 'pngalpha'
+            ext, opts = 'png', (res,self._cropMode(res,src,page))
+        elif fmt == 'BMP':
+            ext, opts = 'bmp', res
+        else:
+            ext, opts = 'pdf' if fmt in ('PDF',0) else 'eps', self.outline
+        key = makeKey('convert',_toolStamp(self.gs),key,ext,opts,page)
+        if dest is None: dest = 'output.'+ext
+        start = time.time()
+        if self.cache is not None and self.cache.fetch(key,ext,os.path.join(self.dir,dest)):
+            if cb is not None: cb('>> Using cached '+dest)
+            self._span(ext,time.time()-start,output=dest,cache='hit')
+            return dest
+        if self.cache is not None: self._span(ext,time.time()-start,cache='miss')
+        t = time.time()
+        dest = self._convert(src,fmt,cb,res,dest,page)
+        if self.cache is not None: self.cache.put(key,ext,os.path.join(self.dir,dest),time.time()-t)
+        return dest
+        
+    def read(self, name):
+        # the contents of a generated file
+        with open(os.path.join(self.dir,name),'rb') as f:
+            return f.read()
+        
+    def output(self, src, fmt, cb=None, res=None):
+        # convert the compiled document and return the result in memory
+        return self.read(self.convert(src,fmt,cb,res))
+        
+    def render(self, data, fmt, cb=None, res=None):
+        # LaTeX source in, rendered EPS, PDF or PNG out
+        return self.output(self.runLatex(data,cb),fmt,cb,res)
+        
+    def convertMany(self, src, formats, cb=None):
+        # convert one compiled document to several formats at once, each Ghostscript job in its own process
+        # formats are 'EPS', 'PDF' or 'PNG', optionally as (format, resolution) pairs
+        # returns a dict mapping each requested format to its output file
+        jobs = []
+        for f in formats:
+            fmt, res = f if isinstance(f,tuple) else (f,self.res)
+            dest = 'output_%d.png'%res if fmt in ('PNG',2) else None
+            jobs.append((f,fmt,res,dest))
+        # do the shared work up front rather than racing for it
+        if any(j[1] not in ('PNG',2) for j in jobs): self._epsDevice()
+        if len(jobs) > 1 and any(j[1] not in ('PNG',2) or self._cropMode(j[2]) == 'bbox' for j in jobs):
+            self.computeBounds(src)
+        pool = ThreadPool(max(1,min(len(jobs),multiprocessing.cpu_count())))
+        try:
+            results = pool.map(lambda j: self.convert(src,j[1],cb,j[2],j[3]),jobs)
+        finally:
+            pool.close()
+        return dict((j[0],r) for j, r in zip(jobs,results))
+        
+    def convertScaled(self, src, resolutions, cb=None, page=None):
+        # PNGs of src at several resolutions from one raster at the highest, returning {resolution: output_<res>.png}
+        # the rest are downsampled from it, so need PIL, otherwise each resolution is rendered separately
+        resolutions = sorted(set(int(r) for r in resolutions),reverse=True)
+        outputs = dict((r,'output_%d.png'%r) for r in resolutions)
+        if Image is None or len(resolutions) == 1:
+            return dict((r,self.convert(src,'PNG',cb,r,outputs[r],page)) for r in resolutions)
+        top = resolutions[0]
+        key = self.keys.get(src) or makeKey(open(os.path.join(self.dir,src),'rb').read())
+        keys = dict((r,makeKey('convert',_toolStamp(self.gs),key,'png',('scaled',r,top),page)) for r in resolutions)
+        if self.cache is not None and all(self.cache.fetch(keys[r],'png',os.path.join(self.dir,outputs[r])) for r in resolutions):
+            if cb is not None: cb('>> Using cached '+', '.join(outputs[r] for r in resolutions))
+            return outputs
+        t = time.time()
+        # sized by the bbox crop, as convert() is with the default self.crop, so the sizes match its output
+        # all anchored at the bottom-left of the bbox like the gs offset
+        bbox = self.computeBounds(src,page=page)
+        sizes = dict((r,(int(round((bbox[2]-int(bbox[0]))*r/72.0 + 0.5)),int(round((bbox[3]-int(bbox[1]))*r/72.0 + 0.5)))) for r in resolutions)
+        W = max(int(math.ceil(sizes[r][0]*float(top)/r)) for r in resolutions)
+        H = max(int(math.ceil(sizes[r][1]*float(top)/r)) for r in resolutions)
+        full = 'output_%d-full.png'%top
+        if self._gs('pngalpha',src,full,top,size=(W,H),offset=bbox[:2],page=page,cb=cb) is None:
+            raise RuntimeError('Ghostscript PNG conversion failed')
+        # filter with premultiplied alpha, so the transparent background doesn't bleed into the edges
+        img = Image.open(os.path.join(self.dir,full)).convert('RGBa')
+        resample = getattr(Image,'LANCZOS',None) or Image.ANTIALIAS
+        for r in resolutions:
+            w, h = sizes[r]
+            k = float(top)/r
+            part = img.crop((0,H-int(round(h*k)),int(round(w*k)),H))
+            if r != top: part = part.resize((w,h),resample)
+            part.convert('RGBA').save(os.path.join(self.dir,outputs[r]))
+        if self.cache is not None:
+            cost = (time.time()-t)/len(resolutions)
+            for r in resolutions: self.cache.put(keys[r],'png',os.path.join(self.dir,outputs[r]),cost)
+        return outputs
+        
+    def _compilePacked(self, preamble, items, cb=None):
+        # one snippet per page, with markers in the log so errors and pages can be traced back to each snippet
+        # returns {index: (first page, last page)} and {index: first error message}
+        doc = preamble + '\\begin{document}\n'
+        for i, body in items:
+            doc += '\\typeout{TEXTONIC-SNIPPET %d \\thepage}\n%s\n\\clearpage\n'%(i,body)
+        doc += '\\typeout{TEXTONIC-SNIPPET end \\thepage}\n\\end{document}\n'
+        try:
+            self.runLatex(doc,cb,'packed',halt=False)
+        except RuntimeError:
+            pass    # nonstopmode still gets us a log, and usually most of the pages
+        starts = []
+        errors = {}
+        current = None
+        try:
+            log = open(os.path.join(self.dir,'packed.log'),'rb').read()
+        except IOError:
+            log = ''
+        for line in log.split('\n'):
+            if line.startswith('TEXTONIC-SNIPPET '):
+                marker, page = line.split()[1:3]
+                current = None if marker == 'end' else int(marker)
+                starts.append((current,int(page)))
+            elif line.startswith('!'):
+                if not starts:
+                    # broken preamble, which every snippet shares
+                    return {}, dict((i,line[1:].strip()) for i, body in items)
+                errors.setdefault(current if current is not None else items[-1][0],line[1:].strip())
+        if len(starts) != len(items)+1:
+            # the run died part way through, so blame the snippet it was working on
+            errors.setdefault(starts[-1][0] if starts else items[0][0],'LaTeX failed')
+        pages = {}
+        for (i, first), (j, nxt) in zip(starts,starts[1:]):
+            pages[i] = (first,nxt-1)
+        return pages, errors
+        
+    def renderPacked(self, snippets, formats, cb=None):
+        # compile many bare snippets that share their %! preamble lines in a single LaTeX run, then split the pages
+        # snippets that break the packed run, or don't produce exactly one page, are rendered on their own
+        # returns a list of {'outputs': {format: file in self.dir}, 'error': message or None} in the given order
+        # with the snippet's 'line' too for LaTeX errors located by rendering it on its own
+        parts = [splitSnippet(s) for s in snippets]
+        preamble = parts[0][0]
+        if any(p[0] != preamble for p in parts):
+            raise ValueError('Packed snippets must share the same preamble')
+        results = [{'outputs':{}, 'error':None} for s in snippets]
+        todo = range(len(snippets))
+        suspects = {}
+        for attempt in range(2):
+            pages, errors = self._compilePacked(preamble,[(i,parts[i][1]) for i in todo],cb)
+            if not errors: break
+            suspects.update(errors)
+            todo = [i for i in todo if i not in errors]
+            if not todo: break
+        else:
+            # removing the offenders didn't clean up the run, so trust nothing from it
+            suspects.update((i,None) for i in todo)
+            todo = []
+        for i in todo:
+            if pages.get(i,(0,-1))[0] != pages.get(i,(0,-1))[1]:
+                suspects[i] = None
+        jobs = [(i,fmt) for i in todo if i not in suspects for fmt in formats]
+        def split(job):
+            i, fmt = job
+            try:
+                results[i]['outputs'][fmt] = self.convert('packed.pdf',fmt,cb,dest='packed-%d.%s'%(i,fmt.lower()),page=pages[i][0])
+            except Exception as E:
+                results[i]['error'] = str(E)
+        if jobs:
+            pool = ThreadPool(max(1,min(len(jobs),multiprocessing.cpu_count())))
+            try:
+                pool.map(split,jobs)
+            finally:
+                pool.close()
+        for i in sorted(suspects):
+            try:
+                src = self.runLatex(wrapSource(snippets[i]),cb,'single')
+                for fmt in formats:
+                    results[i]['outputs'][fmt] = self.convert(src,fmt,cb,dest='single-%d.%s'%(i,fmt.lower()))
+            except LatexError as E:
+                results[i]['outputs'] = {}
+                results[i]['error'] = E.message
+                results[i]['line'] = snippetLine(snippets[i],E.line)
+            except Exception as E:
+                results[i]['outputs'] = {}
+                results[i]['error'] = suspects[i] or str(E)
+        return results
+        
+    def _cropMode(self, res, src=None, page=None):
+        if Image is None: return 'bbox'
+        if self.crop == 'auto':
+            # once the bbox is known, as after fitResolution, cropping by it costs no extra pass
+            if src is not None and (self.keys.get(src),page) in self.bounds: return 'bbox'
+            return 'alpha' if res <= self.alphaMaxRes else 'bbox'
+        return self.crop
+        
+    def _cropRaster(self, src, dest, res, page=None, cb=None):
+        # render the whole page once and crop it to the inked pixels
+        full = os.path.splitext(dest)[0]+'-page.png'
+        if self._gs('pngalpha',src,full,res,page=page,cb=cb) is None:
+            raise RuntimeError('Ghostscript PNG conversion failed')
+        img = Image.open(os.path.join(self.dir,full))
+        bbox = img.convert('RGBA').split()[3].getbbox()
+        if bbox is None:
+            raise RuntimeError('Failed to compute bounding box')
+        img.crop(bbox).save(os.path.join(self.dir,dest))
+        return bbox
+        
+    def checkCrop(self, src, tol=0.02):
+        # compare the single-pass crop against the two-pass bbox render, returning (ok, difference)
+        # the grids differ by a sub-pixel offset, so allow a one pixel shift in either direction
+        crop = self.crop
+        try:
+            self.crop = 'alpha'
+            a = Image.open(os.path.join(self.dir,self._convert(src,'PNG',res=self.res,dest='check-alpha.png'))).convert('RGBA')
+            self.crop = 'bbox'
+            b = Image.open(os.path.join(self.dir,self._convert(src,'PNG',res=self.res,dest='check-bbox.png'))).convert('RGBA')
+        finally:
+            self.crop = crop
+        diff = rasterDiff(a,b)
+        return diff <= tol, diff
+        
+    def _epsDevice(self):
+        # recent versions of GS have removed the outdated epswrite driver, so check which driver we need to use
+        # setting self.epsdev overrides the probed one
+        epsdev = self.epsdev or toolInfo(self.gs,'gs').get('epsdev')
+        if epsdev is None:
+            raise RuntimeError('Ghostscript does not support EPS device')
+        return epsdev
+        
+    def _convert(self, src, fmt, cb=None, res=None, dest=None, page=None):
+        if res is None: res = self.res
+        if fmt in ('PNG',2,'BMP'):
+            # BMP is for the clipboard, where there's no alpha, so gs renders it straight onto white
+            if dest is None: dest = 'output.bmp' if fmt == 'BMP' else 'output.png'
+            if fmt != 'BMP' and self._cropMode(res,src,page) == 'alpha':
+                self._cropRaster(src,dest,res,page,cb)
+                return dest
             # src must be an eps or pdf
-            bbox = self.computeBounds(src)
+            bbox = self.computeBounds(src,page=page)
             # bbox is spec in pts
-            w = round((bbox[2]-int(bbox[0]))*self.res/72.0 + 0.5)
-            h = round((bbox[3]-int(bbox[1]))*self.res/72.0 + 0.5)
-            # these need to go AFTER the device specification
-            gsextra = ['-g%dx%d'%(w,h),'-c','<</Install {-%.2f -%.2f translate}>> setpagedevice'%(bbox[0],bbox[1])]
-        else:
-            dest = 'output.eps'
-            # recent versions of GS have removed the outdated epswrite driver, so check which driver we need to use
-            if self.epsdev is None:
-                buffer = StringIO.StringIO()
-                self._exec(gscmd + ['-h'], buffer.write)
-                if 'eps2write' in buffer.getvalue():
-                    self.epsdev = 'eps2write'
-                elif 'epswrite' in buffer.getvalue():
-                    self.epsdev = 'epswrite'
-                else:
-                    raise RuntimeError('Ghostscript does not support EPS device')
-            dev = self.epsdev
-            # crop by replacing the BBOX in the EPS
-            gscmd = gscmd[:4] + ['-dEPSCrop']
-            if self.outline: gscmd.append('-dNOCACHE' if self.epsdev == 'epswrite' else '-dNoOutputFonts')
-        # run the conversion process
-        if self._exec(gscmd+['-o',dest,'-sDEVICE='+dev]+gsextra+['-f',src],cb):
-            raise RuntimeError('Ghostscript EPS conversion failed')
+            w = round((bbox[2]-int(bbox[0]))*res/72.0 + 0.5)
+            h = round((bbox[3]-int(bbox[1]))*res/72.0 + 0.5)
+            if self._gs('bmp16m' if fmt == 'BMP' else 'pngalpha',src,dest,res,size=(w,h),offset=bbox[:2],page=page,cb=cb) is None:
+                raise RuntimeError('Ghostscript %s conversion failed'%('BMP' if fmt == 'BMP' else 'PNG'))
+            return dest
+        epsdev = self._epsDevice()
+        # eps2write takes the font outlining as a device parameter, epswrite needs the font cache disabled
+        params = [('NoOutputFonts',True)] if self.outline and epsdev == 'eps2write' else []
+        flags = ['-dNOCACHE'] if self.outline and epsdev == 'epswrite' else []
         if fmt in ('PDF',0):
-            # turn the EPS into a PDF to ensure that fonts get outlined
-            # if we didn't want to do this, we wouldn't have used convert
-            src = dest
-            dest = 'output.pdf'
-            if self._exec(gscmd+['-o',dest,'-sDEVICE=pdfwrite','-f',src],cb):
+            if dest is None: dest = 'output.pdf'
+            if epsdev == 'eps2write':
+                # pdfwrite outlines fonts itself, so crop to the integer bbox EPSCrop would use and skip the EPS
+                bbox = self.computeBounds(src,page=page)
+                x0, y0 = math.floor(bbox[0]), math.floor(bbox[1])
+                size = (math.ceil(bbox[2])-x0, math.ceil(bbox[3])-y0)
+                if self._gs('pdfwrite',src,dest,params=params,size=size,offset=(x0,y0),page=page,cb=cb) is None:
+                    raise RuntimeError('Ghostscript PDF conversion failed')
+                return dest
+            # old epswrite builds can only outline fonts by turning the EPS into a PDF
+            # crop by replacing the BBOX in the EPS
+            eps = os.path.splitext(dest)[0]+'-pdf.eps'
+            if self._gs(epsdev,src,eps,params=params,flags=flags,page=page,cb=cb) is None:
+                raise RuntimeError('Ghostscript EPS conversion failed')
+            if self._gs('pdfwrite',eps,dest,params=params,flags=flags+['-dEPSCrop'],cb=cb) is None:
                 raise RuntimeError('Ghostscript PDF conversion failed')
+            return dest
+        if dest is None: dest = 'output.eps'
+        if self._gs(epsdev,src,dest,params=params,flags=flags,page=page,cb=cb) is None:
+            raise RuntimeError('Ghostscript EPS conversion failed')
         return dest
         
-    def clipboard(self,src,fmt):
+    def clipboard(self,data,fmt):
+        # data is the rendered output, as returned by output()
         import win32clipboard as clip
         clip.OpenClipboard()
         clip.EmptyClipboard()
         try:
-            data = open(os.path.join(self.dir,src),'rb').read()
             if fmt == 'BMP':
-                # to copy BMP data to the clipboard we need to generate the appropriate BITMAP header
-                # let's cheat instead by using PIL to open the PNG, write a temporary BMP and 
-                from PIL import Image
-                png = Image.open(os.path.join(self.dir,src))
-                src += '.bmp'
-                # BMP does not really RGBA, so blend with white
-                # https://stackoverflow.com/questions/9166400/convert-rgba-png-to-rgb-with-pil
-                bmp = Image.new("RGB", png.size, (255, 255, 255))                
-                bmp.paste(png, mask=png.split()[3])
-                buffer = StringIO.StringIO() # use a StringIO object instead of a temp file
-                bmp.save(buffer,format='bmp')
+                # a DIB is a BMP file without its BITMAPFILEHEADER
                 iformat = clip.CF_DIB
-                data = buffer.getvalue()[14:] # bypass the BITMAPFILEHEADER
+                data = data[14:]
             elif fmt == 'PNG':
                 iformat = clip.RegisterClipboardFormat('PNG')
             elif fmt == 'PDF':
@@ -132,13 +998,104 @@ class TexTonic:
         clip.CloseClipboard()
         return True
         
+    def recycle(self):
+        # forget the last render so the workspace can be reused, keeping precompiled formats and the gs session
+        # unless there are so many preambles that they have to go too
+        self.aborted = False
+        self.keys.clear()
+        self.bounds.clear()
+        self.profile = None
+        keep = len(self.formats) <= self.maxFormats
+        if not keep:
+            self.formats.clear()
+            self.fmtWorked.clear()
+        for name in os.listdir(self.dir):
+            if keep and name.startswith('pre_'): continue
+            try:
+                os.remove(os.path.join(self.dir,name))
+            except OSError:
+                pass
+        
     def cleanup(self):
-        if getattr(self,'pipe',False):
-            self.pipe.terminate()
-            self.pipe = None
+        if getattr(self,'session',None) is not None:
+            self.session.close()
+            self.session = None
+        for pipe in list(getattr(self,'pipes',())):
+            try:
+                pipe.terminate()
+            except OSError:
+                pass    # already exited
         if getattr(self,'dir',''):
             try:
                 shutil.rmtree(self.dir)
             except Exception as E:
                 print('!! Failed to remove dir,',E,file=sys.stderr)
             self.dir = None
+
+class WorkspacePool:
+    # isolated TexTonic workspaces for renders running side by side, at most size at once (default one per core)
+    # workspaces are recycled rather than recreated, so each keeps its temp dir, formats and gs session
+    def __init__(self, size=None, setup=None, **kwargs):
+        self.size = size or multiprocessing.cpu_count()
+        self.setup = setup      # called with each new TexTonic, e.g. to set the latex and gs paths
+        self.kwargs = kwargs    # passed on to TexTonic
+        self.workspaces = []
+        self.idle = []
+        self.busy = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        
+    def acquire(self, block=True):
+        # a TexTonic for the caller's sole use until release, or None if all are busy and not block
+        with self.cond:
+            while not self.closed and self.busy >= self.size:
+                if not block: return None
+                self.cond.wait()
+            if self.closed: raise RuntimeError('Workspace pool closed')
+            self.busy += 1
+            tex = self.idle.pop() if self.idle else None
+        if tex is None:
+            try:
+                tex = TexTonic(**self.kwargs)
+                if self.setup is not None: self.setup(tex)
+            except Exception:
+                with self.cond:
+                    self.busy -= 1
+                    self.cond.notify()
+                raise
+            with self.cond: self.workspaces.append(tex)
+        return tex
+        
+    def release(self, tex):
+        # close() may already have removed the workspace, in which case there's nothing to recycle
+        try:
+            if tex.dir is not None and not self.closed: tex.recycle()
+        except (IOError,OSError) as E:
+            print('!! Failed to recycle workspace,',E,file=sys.stderr)
+            tex.cleanup()
+        with self.cond:
+            self.busy -= 1
+            if tex.dir is None or self.closed:
+                if tex in self.workspaces: self.workspaces.remove(tex)
+                tex.cleanup()
+            else:
+                self.idle.append(tex)   # most recently used first, its session is the warmest
+            self.cond.notify()
+            
+    @contextlib.contextmanager
+    def workspace(self, block=True):
+        tex = self.acquire(block)
+        try:
+            yield tex
+        finally:
+            if tex is not None: self.release(tex)
+            
+    def close(self):
+        # stop whatever is still running and remove every workspace
+        with self.cond:
+            self.closed = True
+            workspaces, self.workspaces, self.idle = self.workspaces, [], []
+            self.cond.notify_all()
+        for tex in workspaces:
+            tex.abort()
+            tex.cleanup()
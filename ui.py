@@ -1,49 +1,71 @@
 from PySide import QtGui, QtCore
 import os, sys, time
+import threading
+import collections
 import textonic
-        
+import cache
+        
+class RenderJob(object):
+    # one request for the worker: render data to format, then optionally copy it to the clipboard or save it
+    # callback(errmsg) is called in the UI thread once the job has completed
+    # previews carry fit=(width, height, dpi) of the viewport, so they are only rendered as large as they can be shown
+    def __init__(self,data,format,revision,action=None,target=None,callback=None,fit=None):
+        self.data = data
+        self.format = format
+        self.revision = revision
+        self.action = action
+        self.target = target
+        self.callback = callback
+        self.fit = fit
+        self.res = None         # resolution the worker rendered at
+        self.error = None       # the exception the job failed with
+        self.profile = None     # per-stage timings, filled in by the worker
+
 class WorkerObj(QtCore.QObject):
-    finished = QtCore.Signal(str)
+    # results carry the job they came from, so superseded previews can be ignored
+    finished = QtCore.Signal(str,object)
     progress = QtCore.Signal(str)
-    preview = QtCore.Signal(str)
+    preview = QtCore.Signal(object,int)
     
     def __init__(self):
         super(WorkerObj,self).__init__()
-        self.tex = textonic.TexTonic()
-        self.hasChanged = True
-        self.format = 'PNG'
-        self.files = {}
-        
-    def run(self, format=None):
+        self.tex = textonic.TexTonic(cache=cache.RenderCache())
+        self.compiled = None    # source of the current textonic.pdf
+        self.job = None
+        
+    def run(self):
+        job = self.job
+        self.tex.aborted = False
+        self.tex.startProfile(job.action or 'preview')
         try:
-            if format is not None:
-                self.format = format
-            if self.hasChanged:
-                self.files.clear()
-                self.tex.runLatex(self.data,self.progress.emit)
-            dest = self.tex.convert('textonic.pdf',self.format,self.progress.emit)
-            if self.format == 'PNG': self.preview.emit(os.path.join(self.tex.dir,dest))
+            if job.data != self.compiled:
+                self.compiled = None
+                self.tex.runLatex(job.data,self.progress.emit)
+                self.compiled = job.data
+            if job.fit is not None: job.res = self.tex.fitResolution('textonic.pdf',*job.fit)
+            if job.action == 'clipboard' and job.format == 'PDF' and not self.tex.outline:
+                data = self.tex.read('textonic.pdf')    # no need to convert if we aren't outlining
+            else:
+                data = self.tex.output('textonic.pdf',job.format,self.progress.emit,job.res)
+            if job.action == 'clipboard':
+                self.tex.clipboard(data,job.format)
+            elif job.action == 'save':
+                with open(job.target,'wb') as f: f.write(data)
+            elif job.format == 'PNG':
+                self.preview.emit(data,job.revision)
         except Exception as E:
-            self.finished.emit(str(E))
+            job.error = E
+            job.profile = self.tex.finishProfile()
+            self.finished.emit(str(E),job)
             return False
         else:
-            self.finished.emit('')
+            job.profile = self.tex.finishProfile()
+            self.finished.emit('',job)
             return True
         
-    def toClipboard(self,fmt):
-        filename = 'output.'+fmt
-        if self.hasChanged:
-            if not self.run(fmt): return False
-        if fmt == 'PDF' and not self.tex.outline:
-            filename = 'textonic.pdf'
-        elif fmt == 'BMP':
-            filename = 'output.png'		
-        try:
-            self.tex.clipboard(filename,fmt)
-        except Exception as E:
-            self.finished.emit(str(E))
-            return False
-        return True
+    def cancel(self):
+        # called from the UI thread when newer text arrives
+        self.tex.abort()
         
     def cleanup(self):
         self.tex.cleanup()
@@ -92,11 +114,21 @@ class LatexHighlight(QtGui.QSyntaxHighlighter):
         if commentStart == -1: commentStart = len(text)
         
 class TexTonicUI(QtGui.QMainWindow):
+    toolFailed = QtCore.Signal(str,str,str)
+    
     def __init__(self):
         super(TexTonicUI,self).__init__()
         self.setWindowTitle('TexTonic')
         self.isModified = False
         self.filename = None
+        self.revision = 0       # latest text sent for rendering
+        self.pending = None     # preview waiting for the current one to stop
+        self.queue = collections.deque()    # clipboard and export jobs, which are never superseded
+        self.editTime = None    # first edit not yet shown in the preview
+        self.latencies = []     # seconds from keystroke to preview
+        self.fullRes = False    # preview at the export resolution rather than fitted to the viewport
+        self.fingerprint = None # of the latest preview scheduled, see textonic.fingerprint
+        self.skipped = 0        # previews not rendered because the edit couldn't change them
         
         self.thread = QtCore.QThread()
         self.worker = WorkerObj()
@@ -106,7 +138,9 @@ class TexTonicUI(QtGui.QMainWindow):
         self.worker.finished.connect(self.thread.quit)
         self.worker.preview.connect(self.newImage)
         self.thread.started.connect(self.worker.run)
+        self.thread.finished.connect(self.workerIdle)
         
+        self.toolFailed.connect(self.toolMissing)
         if not self.loadSettings(): # need worker to exist to hold settings
             QtGui.QMessageBox.critical(None, 'Error', 'Cannot find dependent applications, cannot continue')
             # we cannot quit immediately, instead we schedule a quit
@@ -127,10 +161,9 @@ class TexTonicUI(QtGui.QMainWindow):
         
         self.show()
         
-    def checkAppExists(self,name,file,query):
+    def checkAppExists(self,name,file,kind):
         try:
-            import subprocess
-            subprocess.check_output([file,query],shell=False)
+            textonic.toolInfo(file,kind,refresh=True)
             return file
         except Exception as E:
             print E
@@ -140,7 +173,7 @@ class TexTonicUI(QtGui.QMainWindow):
             if ret == QtGui.QMessageBox.Yes:
                 file, filter = QtGui.QFileDialog.getOpenFileName(self,'Locate %s'%name,dir=os.path.dirname(file),filter='Applications (*.exe)')
                 if len(file):
-                    return self.checkAppExists(name,file,query)
+                    return self.checkAppExists(name,file,kind)
         
     def initUI(self):
         self.setStyleSheet( """
@@ -194,19 +227,24 @@ class TexTonicUI(QtGui.QMainWindow):
         m.addAction('&Quit',self.close,QtGui.QKeySequence.Quit)
         
         m = menu.addMenu('&Options')
-        m.addAction('Render now',self.workerRun)
+        m.addAction('Render now',self.renderNow)
         act = m.addAction('Autodetect changes')
         act.setCheckable(True)
         act.setChecked(self.auto)
         act.toggled.connect(self.toggleAuto)
         m.addSeparator()
         m.addAction('Set resolution',self.setResolution)
+        itm = m.addAction('Full resolution preview')
+        itm.setCheckable(True)
+        itm.toggled.connect(self.toggleFullRes)
         itm = m.addAction('Outline fonts (PDF)')
         itm.setCheckable(True)
         itm.setChecked(self.worker.tex.outline)
         itm.toggled.connect(self.toggleOutline)
         m.addSeparator()
         m.addAction('Open temp directory',self.openTempDir)
+        m.addAction('Render cache statistics',self.cacheStats)
+        m.addAction('Clear render cache',self.worker.tex.cache.clear)
             
         m = menu.addMenu('&Help')
         m.addAction('&Website',self.website)
@@ -223,11 +261,18 @@ class TexTonicUI(QtGui.QMainWindow):
         status.addWidget(self.statusicon)
         self.statusmsg = QtGui.QLabel('Ready',self)
         status.addWidget(self.statusmsg)
+        self.statusprofile = QtGui.QLabel(self)
+        status.addPermanentWidget(self.statusprofile)
         
     def toggleAuto(self,val):
         self.auto = val
-        if val: self.workerRun()
+        if val: self.workerStart()
             
+    def toggleFullRes(self,val):
+        # the full resolution render is cached, so exporting afterwards costs nothing
+        self.fullRes = val
+        self.workerStart()
+        
     def toggleOutline(self,val):
         self.worker.outline = val
         
@@ -240,58 +285,86 @@ class TexTonicUI(QtGui.QMainWindow):
     def openTempDir(self):
         QtGui.QDesktopServices.openUrl(QtCore.QUrl.fromLocalFile(self.worker.tex.dir))
         
-    def copyEPS(self):	self.worker.toClipboard('EPS')
-    def copyPDF(self):	self.worker.toClipboard('PDF')
-    def copyPNG(self):	self.worker.toClipboard('PNG')
-    def copyBMP(self):	self.worker.toClipboard('BMP')
+    def cacheStats(self):
+        st = self.worker.tex.cache.stats()
+        QtGui.QMessageBox.information(self,'Render cache',
+            'Hits: %(hits)d\nMisses: %(misses)d\nHit ratio: %(ratio).0f%%\nProcess time saved: %(saved).1f s\nUnchanged edits not rendered: %(skipped)d'%dict(st,ratio=100*st['ratio'],skipped=self.skipped))
+        
+    def copyEPS(self):	self.workerSubmit('EPS','clipboard')
+    def copyPDF(self):	self.workerSubmit('PDF','clipboard')
+    def copyPNG(self):	self.workerSubmit('PNG','clipboard')
+    def copyBMP(self):	self.workerSubmit('BMP','clipboard')
     
     def saveOutput(self):
         name, filter = QtGui.QFileDialog.getSaveFileName(self,'Save output as', filter='PDF file (*.pdf);;EPS file (*.eps);;PNG image (*.png)')
         if not len(name): return
         format = filter.split(' ',1)[0]
-        self.workerRun(format)
-        # copy the output file
-        open(name,'wb').write(open(os.path.join(self.worker.tex.dir,'output.'+format),'rb').read())
+        # the worker copies the output file once it is ready
+        self.workerSubmit(format,'save',name)
         
-    def newImage(self,filename):
-        if filename is None:
+    def newImage(self,data,rev=None):
+        if rev is not None and rev != self.revision:
+            return  # superseded while rendering
+        if data is None:
             self.preview.clear()
             self.preview.resize(0,0)
             return
-        pix = QtGui.QPixmap(filename)
+        pix = QtGui.QPixmap()
+        pix.loadFromData(data,'PNG')
         self.preview.resize(pix.size())
         self.preview.setPixmap(pix)
         self.preview.setMask(pix.mask())
+        if rev is not None and self.editTime is not None:
+            self.latencies.append(time.time()-self.editTime)
+            self.editTime = None
         
-    def workerRun(self,format='PNG'):
-        if not self.workerStart(format): return False
-        QtGui.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
-        while self.thread.isRunning():
-            QtGui.QApplication.processEvents()
-        QtGui.QApplication.restoreOverrideCursor()
+    def workerSubmit(self,format,action,target=None,callback=None):
+        data = self.editor.toPlainText()
+        if not len(data): return False
+        self.queue.append(RenderJob(textonic.wrapSource(data),format,self.revision,action,target,callback))
+        if not self.thread.isRunning(): self.workerIdle()
         return True
         
-    def workerStart(self,format='PNG',redo=True):
+    def renderNow(self):
+        self.workerStart(force=True)
+        
+    def workerStart(self,format='PNG',force=False):
         self.autoTimer.stop()
-        if self.thread.isRunning(): return False
         data = self.editor.toPlainText()
         if not len(data): return False
-        if not r'\begin{document}' in data and not r'\documentclass' in data:
-            preamble = r"""
-                \documentclass{article}
-                \usepackage{amsmath,amssymb}
-                \pagestyle{empty}
-            """
-            mainmatter = ''
-            for l in data.split('\n'):
-                if l.startswith('%!'):
-                    preamble += l[2:] + '\n'
-                else:
-                    mainmatter += l + '\n'
-            data = preamble + '\\begin{document}\n' + mainmatter + '\\end{document}\n'
-        self.worker.data = data
-        self.worker.format = format
-        if redo: self.worker.hasChanged = True
+        fit = None
+        if format == 'PNG' and not self.fullRes:
+            view = self.scroller.viewport()
+            fit = (view.width(),view.height(),self.scroller.logicalDpiX())
+        data = textonic.wrapSource(data)
+        fp = textonic.fingerprint(data,format,self.worker.tex.res,self.worker.tex.outline,fit)
+        if fp == self.fingerprint and not force:
+            # only comments or spacing changed, so the preview already shows (or is rendering) this
+            self.skipped += 1
+            self.editTime = None
+            if not self.thread.isRunning():
+                self.statusmsg.setText('No change to render (%d skipped this session)'%self.skipped)
+            return False
+        self.fingerprint = fp
+        self.revision += 1
+        self.pending = RenderJob(data,format,self.revision,fit=fit)
+        if self.thread.isRunning():
+            # supersede a preview in progress, workerIdle starts this one once it has stopped
+            if self.worker.job.action is None: self.worker.cancel()
+        else:
+            self.workerIdle()
+        return True
+        
+    def workerIdle(self):
+        # start the next job, exports first since someone is waiting on them
+        if self.thread.isRunning(): return
+        if self.queue:
+            self.worker.job = self.queue.popleft()
+        elif self.pending is not None:
+            self.worker.job = self.pending
+            self.pending = None
+        else:
+            return
         self.loader.start()
         self.log.clear()
         self.log.has_err = False
@@ -299,13 +372,24 @@ class TexTonicUI(QtGui.QMainWindow):
         self.thread.start()
         return True
         
-    def workerDone(self,errmsg):
+    def workerDone(self,errmsg,job):
+        if job.callback is not None: job.callback(errmsg)
+        if job.action is None and job.revision != self.revision: return # superseded, the newer render reports instead
         self.loader.stop()
+        if job.profile is not None:
+            self.statusprofile.setText(textonic.profileSummary(job.profile))
+        if isinstance(job.error,textonic.LatexError):
+            # report the line as the editor numbers it, rather than the wrapped document
+            line = textonic.snippetLine(self.editor.toPlainText(),job.error.line)
+            errmsg = job.error.message if line is None else 'Line %d: %s'%(line,job.error.message)
         if len(errmsg):
             self.statusmsg.setText('Error: '+errmsg)
             self.statusicon.setPixmap('err.png')
         else:
-            self.statusmsg.setText('Complete')
+            msg = {'clipboard':'Copied to clipboard', 'save':'Saved %s'%job.target}.get(job.action,'Complete')
+            if job.action is None and self.latencies: msg += ' (preview %.0f ms after edit)'%(1000*self.latencies[-1])
+            if job.res is not None and job.res < self.worker.tex.res: msg += ', shown at %d dpi'%job.res
+            self.statusmsg.setText(msg)
             self.statusicon.setPixmap('success.png')
         
     def onChange(self,modified=True):
@@ -317,7 +401,7 @@ class TexTonicUI(QtGui.QMainWindow):
             self.fileMenu.actions()[3].setEnabled(self.filename is not None)
         # start the renderer timer
         if modified and self.auto: self.autoTimer.start()
-        self.worker.hasChanged = True
+        if modified and self.editTime is None: self.editTime = time.time()
         self.setWindowTitle('TexTonic' + (' (*)' if modified else ''))
         
     def updateIco(self):
@@ -326,10 +410,10 @@ class TexTonicUI(QtGui.QMainWindow):
     def addLog(self,s):
         c = self.log.textCursor()
         c.movePosition(QtGui.QTextCursor.End)
-        if s.startswith('!'): self.log.has_err = True
+        # the worker sends batches of lines
+        if s.startswith('!') or '\n!' in s: self.log.has_err = True
         c.insertText(s+'\n')
         if not self.log.has_err: self.log.setTextCursor(c)
-        QtGui.QApplication.processEvents()
         
     def website(self):
         QtGui.QDesktopServices.openUrl('http://bitbucket.org/martijnj/textonic')
@@ -344,7 +428,11 @@ class TexTonicUI(QtGui.QMainWindow):
         if not self.saveChanges():
             e.ignore()
             return False
+        self.pending = None
+        self.queue.clear()
+        if self.thread.isRunning(): self.worker.cancel()
         self.thread.quit()
+        self.thread.wait()
         self.worker.cleanup()
         self.saveSettings()
         e.accept()
@@ -367,6 +455,7 @@ class TexTonicUI(QtGui.QMainWindow):
         self.log.clear()
         self.log.has_err = False
         self.newImage(None)
+        self.fingerprint = None
         return True
         
     def actionSave(self):
@@ -401,14 +490,39 @@ class TexTonicUI(QtGui.QMainWindow):
         self.auto = self.settings.value('auto','true') == 'true'
         self.resize(self.settings.value('winsz', self.size()))
         
-        latex = self.checkAppExists('PDFLatex',self.settings.value('latex',self.worker.tex.latex),'--version')
-        if latex is None: return False
-        else: self.worker.tex.latex = latex
-        gs = self.checkAppExists('Ghostscript',self.settings.value('gs',self.worker.tex.gs),'-v')
-        if gs is None: return False
-        else: self.worker.tex.gs = gs
+        # executables probed in an earlier session are trusted until validated in the background
+        known = []
+        for name, kind in [['PDFLatex','latex'],['Ghostscript','gs']]:
+            file = self.settings.value(kind,getattr(self.worker.tex,kind))
+            if textonic.knownTool(file) is not None:
+                known.append((name,file,kind))
+            else:
+                file = self.checkAppExists(name,file,kind)
+                if file is None: return False
+            setattr(self.worker.tex,kind,file)
+        if known:
+            t = threading.Thread(target=self.validateTools,args=(known,))
+            t.daemon = True
+            t.start()
         return True
         
+    def validateTools(self,tools):
+        # runs in a background thread, re-probing each (name, file, kind) in case it no longer works
+        for name, file, kind in tools:
+            try:
+                textonic.toolInfo(file,kind,refresh=True)
+            except Exception as E:
+                print E
+                self.toolFailed.emit(name,file,kind)
+                
+    def toolMissing(self,name,file,kind):
+        file = self.checkAppExists(name,file,kind)
+        if file is None:
+            QtGui.QMessageBox.critical(self, 'Error', 'Cannot find dependent applications, cannot continue')
+            self.close()
+            return
+        setattr(self.worker.tex,kind,file)
+        
     def saveSettings(self):
         if getattr(self,'settings',None) is None: return
         self.settings.setValue('res',self.worker.tex.res)